@@ -0,0 +1,69 @@
+'''
+Encodes tiles on a few threads, so a worker cuts the next tile while the last ones are compressed.
+Pillow releases the GIL while zlib compresses, so the threads run alongside the worker.
+Encoded tiles are written by the worker in the order they were given,
+and at most a few tiles per thread wait to be written, which bounds the memory they hold.
+Once an encode or write fails, nothing given after it is written.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
+
+COMPRESS_LEVEL = 6 # Pillow's default
+
+
+def png_bytes(im, compress_level=COMPRESS_LEVEL):
+	buf = io.BytesIO()
+	im.save(buf, format='PNG', compress_level=compress_level)
+	return buf.getvalue()
+
+
+class BackgroundWriter:
+	def __init__(self, threads=2, queue=None):
+		# with 0 threads every tile is encoded and written as it is given
+		self.executor = ThreadPoolExecutor(threads) if threads else None
+		self.queue = queue or 4 * threads
+		self.pending = deque()
+
+	def put(self, encode, write=None):
+		# encode() runs on a thread, then write(encoded) on this one
+		if not self.executor:
+			result = encode()
+			if write:
+				write(result)
+			return
+		self.pending.append((self.executor.submit(encode), write))
+		while len(self.pending) > self.queue:
+			self.flush_one()
+
+	def flush_one(self):
+		# an error raised while encoding surfaces here
+		future, write = self.pending.popleft()
+		result = future.result()
+		if write:
+			write(result)
+
+	def close(self):
+		try:
+			while self.pending:
+				self.flush_one()
+		finally:
+			if self.executor:
+				self.executor.shutdown(cancel_futures=True)
+
+	def abort(self):
+		# drop the tiles not yet written, e.g. once an error is raised
+		# encodes already running finish, but nothing more is written
+		self.pending.clear()
+		if self.executor:
+			self.executor.shutdown(cancel_futures=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		# an error leaves the rest unwritten, so a later write never runs after one that failed
+		if exc[0] is None:
+			self.close()
+		else:
+			self.abort()
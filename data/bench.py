@@ -0,0 +1,259 @@
+'''
+Times the data scripts on synthetic scans, so they can be benchmarked without the real drawings.
+Spec pages have specimens of random strokes on a rough grid, within a dark scanner bed.
+Blob pages are a field of continuous lines across the whole page.
+For each dpi, spec_tile.py and spec_rotateflip.py run on the spec pages,
+then blob_grid.py, blob_tile.py, tfrecord.py and tfrecord_reverse.py on the blob pages.
+Each script runs as it would from the command line, in a folder of its own under dir_out.
+Its wall time, items per second, and the peak RSS of its largest process are written to a json baseline.
+A later run with --compare reports the steps that got slower than that baseline.
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from PIL import Image, ImageDraw
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+# a fresh interpreter starts each script and reads the usage of it and its workers,
+# which it waits for. a child forked from this process would report the peak RSS of this one
+LAUNCHER = '''
+import json, resource, subprocess, sys
+code = subprocess.call(sys.argv[2:])
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(sys.argv[1], 'w') as f:
+	json.dump([usage.ru_maxrss, usage.ru_utime + usage.ru_stime], f)
+sys.exit(code)
+'''
+
+
+def walk(rng, x, y, length, step, bounds):
+	# a random walk that turns a little at each step, kept within bounds
+	l, t, r, b = bounds
+	angle = rng.uniform(0, 2 * math.pi)
+	points = [(x, y)]
+	for _ in range(length):
+		angle += rng.gauss(0, 0.3)
+		x = min(max(x + step * math.cos(angle), l), r)
+		y = min(max(y + step * math.sin(angle), t), b)
+		points.append((x, y))
+	return points
+
+
+def spec_page(rng, dpi, rows, cols):
+	# specimens of about res pixels, in cells with room for the 1.5 * res crop of spec_tile.py
+	s = dpi // 300
+	res = 256 * s
+	cell = res * 2
+	margin = 150 * s
+	bed = 60 * s
+	w = 2 * (bed + margin) + cols * cell
+	h = 2 * (bed + margin) + rows * cell
+	im = Image.new('RGB', (w, h), (20, 20, 20))
+	draw = ImageDraw.Draw(im)
+	draw.rectangle((bed, bed, w - bed - 1, h - bed - 1), fill=(235, 232, 225))
+	for row in range(rows):
+		for col in range(cols):
+			# centred in the cell, give or take a little
+			x = bed + margin + col * cell + cell / 2 + rng.uniform(-0.1, 0.1) * res
+			y = bed + margin + row * cell + cell / 2 + rng.uniform(-0.1, 0.1) * res
+			half = res * rng.uniform(0.3, 0.45)
+			bounds = (x - half, y - half, x + half, y + half)
+			# each stroke starts on one already drawn, so the specimen is in one piece
+			points = [(x, y)]
+			for _ in range(rng.randint(3, 8)):
+				stroke = walk(rng, *rng.choice(points), 60, 4 * s, bounds)
+				draw.line(stroke, fill=(30, 30, 30), width=3 * s, joint='curve')
+				points += stroke
+	return im
+
+
+def blob_page(rng, dpi, rows, cols):
+	# a grid of rows x cols units, with half a unit of margin around it
+	unit = int((dpi / 300) * 256)
+	s = dpi // 300
+	w = (cols + 1) * unit
+	h = (rows + 1) * unit
+	im = Image.new('RGB', (w, h), (235, 232, 225))
+	draw = ImageDraw.Draw(im)
+	bounds = (0, 0, w - 1, h - 1)
+	for _ in range(rows * cols * 4):
+		start = (rng.uniform(0, w), rng.uniform(0, h))
+		draw.line(walk(rng, *start, 200, 6 * s, bounds), fill=(30, 30, 30), width=3 * s, joint='curve')
+	return im
+
+
+def make_scans(dir_out, dpi, pages, rows, cols, seed):
+	rng = random.Random(seed)
+	os.makedirs(f'{dir_out}/spec/in', exist_ok=True)
+	os.makedirs(f'{dir_out}/blob/in', exist_ok=True)
+	for i in range(pages):
+		spec_page(rng, dpi, rows, cols).save(f'{dir_out}/spec/in/{i}.png')
+		blob_page(rng, dpi, rows, cols).save(f'{dir_out}/blob/in/{i}.png')
+	adj = [{'index': i, 'x': 0.5, 'y': 0.5} for i in range(pages)]
+	with open(f'{dir_out}/blob/adjustment.json', 'w') as f:
+		json.dump(adj, f, indent=4)
+
+
+def count_files(path, ext='.png'):
+	# tfrecord_reverse.py writes its .png files without the extension
+	return sum(f.endswith(ext) for _, _, files in os.walk(path) for f in files)
+
+
+def count_records(path):
+	with open(f'{path}/manifest.json', 'r') as f:
+		return sum(shard['count'] for shard in json.load(f)['shards'].values())
+
+
+def run(name, args, cwd, count):
+	# the script's wall time, and the peak RSS of the largest of its processes
+	usage_path = f'{cwd}/{name}.usage'
+	cmd = [sys.executable, '-c', LAUNCHER, usage_path, sys.executable, f'{SCRIPTS}/{name}.py'] + args
+	start = time.perf_counter()
+	with open(f'{cwd}/{name}.log', 'w') as log:
+		code = subprocess.call(cmd, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+	wall = time.perf_counter() - start
+	if code != 0:
+		raise RuntimeError(f'{name} exited with {code}, see {cwd}/{name}.log')
+	with open(usage_path, 'r') as f:
+		maxrss, cpu = json.load(f)
+	items = count()
+	return {
+		'step': name,
+		'wall': round(wall, 3),
+		'cpu': round(cpu, 3),
+		'items': items,
+		'per_sec': round(items / wall, 2),
+		'peak_rss_mb': round(maxrss / 1024, 1)
+	}
+
+
+def bench(dir_out, dpi, pages, rows, cols, seed, resolution):
+	res = 256 * (dpi // 300)
+	spec = f'{dir_out}/spec'
+	blob = f'{dir_out}/blob'
+	steps = [
+		('spec_tile', ['in', str(res), '--force'], spec, lambda: count_files(f'{spec}/tile')),
+		('spec_rotateflip', ['tile'], spec, lambda: count_files(f'{spec}/tile')),
+		('blob_grid', ['in', str(dpi), '--rows', str(rows), '--cols', str(cols), '--force'], blob,
+			lambda: count_files(f'{blob}/grid')),
+		('blob_tile', ['in', str(dpi), str(resolution), '--rows', str(rows), '--cols', str(cols), '--seed', str(seed), '--force'], blob,
+			lambda: count_files(f'{blob}/tile')),
+		('tfrecord', ['tile', '--seed', str(seed), '--size', str(1 << 24)], blob,
+			lambda: count_records(f'{blob}/tfrecord')),
+		('tfrecord_reverse', ['tfrecord'], blob, lambda: count_files(f'{blob}/tfrecord_reverse', ''))
+	]
+	results = []
+	for name, args, cwd, count in steps:
+		result = {'dpi': dpi, **run(name, args, cwd, count)}
+		print(f'{dpi} dpi {name}: {result["items"]} in {result["wall"]}s, ' +
+			f'{result["per_sec"]}/s, peak rss {result["peak_rss_mb"]}MB')
+		results.append(result)
+	return results
+
+
+def compare(results, filepath, tolerance):
+	# steps whose wall time grew by more than tolerance since the baseline
+	with open(filepath, 'r') as f:
+		baseline = {(r['dpi'], r['step']): r for r in json.load(f)['results']}
+	slower = []
+	for r in results:
+		old = baseline.get((r['dpi'], r['step']))
+		if not old:
+			continue
+		ratio = r['wall'] / max(old['wall'], 1e-9)
+		print(f'{r["dpi"]} dpi {r["step"]}: {old["wall"]}s -> {r["wall"]}s ({ratio:.2f}x)')
+		if ratio > 1 + tolerance:
+			slower.append(r)
+	return slower
+
+
+def main(dir_out, dpis, pages, rows, cols, seed, resolution, file_out):
+	results = []
+	for dpi in dpis:
+		# every run starts from new scans, so no script finds its cache
+		work = f'{dir_out}/{dpi}'
+		shutil.rmtree(work, ignore_errors=True)
+		make_scans(work, dpi, pages, rows, cols, seed)
+		results += bench(work, dpi, pages, rows, cols, seed, resolution)
+	data = {
+		'machine': {
+			'platform': platform.platform(),
+			'python': platform.python_version(),
+			'cpus': os.cpu_count()
+		},
+		'args': {'pages': pages, 'rows': rows, 'cols': cols, 'seed': seed, 'resolution': resolution},
+		'results': results
+	}
+	with open(file_out, 'w') as f:
+		json.dump(data, f, indent=4)
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		'--dir_out',
+		type=str,
+		default='bench',
+		help='working folder for the synthetic scans and the output of each script')
+	parser.add_argument(
+		'--dpi',
+		type=int,
+		nargs='+',
+		choices=[300, 600, 1200],
+		default=[300, 600, 1200],
+		help='dpi of the synthetic scans. each is benchmarked in turn')
+	parser.add_argument(
+		'--pages',
+		type=int,
+		default=2,
+		help='spec pages and blob pages made for each dpi')
+	parser.add_argument(
+		'--rows',
+		type=int,
+		default=4,
+		help='rows of specimens on a spec page, and rows in the grid of a blob page')
+	parser.add_argument(
+		'--cols',
+		type=int,
+		default=6,
+		help='columns of specimens on a spec page, and columns in the grid of a blob page')
+	parser.add_argument(
+		'--seed',
+		type=int,
+		default=0,
+		help='seed for the synthetic scans and the scripts. the same seed makes the same scans')
+	parser.add_argument(
+		'--resolution',
+		type=int,
+		default=256,
+		help='resolution of the blob tiles')
+	parser.add_argument(
+		'--out',
+		type=str,
+		default='bench.json',
+		help='json file for the results')
+	parser.add_argument(
+		'--compare',
+		type=str,
+		default=None,
+		help='json file of an earlier run. exits with an error if a step is slower than it by more than --tolerance')
+	parser.add_argument(
+		'--tolerance',
+		type=float,
+		default=0.2,
+		help='fraction by which a step may be slower than the baseline of --compare')
+	args = parser.parse_args()
+	results = main(args.dir_out, args.dpi, args.pages, args.rows, args.cols, args.seed, args.resolution, args.out)
+	if args.compare:
+		slower = compare(results, args.compare, args.tolerance)
+		if slower:
+			print('slower than the baseline:', ', '.join(f'{r["dpi"]} dpi {r["step"]}' for r in slower))
+			sys.exit(1)
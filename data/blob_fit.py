@@ -0,0 +1,92 @@
+'''
+Proposes the x and y offsets of adjustment.json, so the grid of blob_grid.py and blob_tile.py
+is centred on each drawing without editing by hand.
+The dark pixels of each scan are counted along its rows and columns.
+The drawing spans the middle of the ink along each count, leaving out stray marks at either end,
+and the grid is centred on that span, whether the drawing is larger or smaller than the grid.
+Check the proposal with blob_grid.py --preview.
+'''
+import argparse
+from blob_grid import load_adjustment
+from ink import dark_pixels
+import json
+import numpy as np
+from runner import Runner, add_arguments
+from scan import ScanReader
+
+
+def projections(filepath):
+	# dark pixels in each column and in each row, counted a band at a time
+	reader = ScanReader(filepath)
+	w, h = reader.size
+	cols = np.zeros(w, dtype=np.int64)
+	rows = np.zeros(h, dtype=np.int64)
+	for top, band in reader.bands():
+		# dark as the tile scripts count ink, so the fit agrees with them on coloured ink
+		dark = dark_pixels(band)
+		cols += dark.sum(axis=0)
+		rows[top:top + band.height] = dark.sum(axis=1)
+	return cols, rows
+
+
+def best_offset(proj, size, q=0.005):
+	# offset of a window of length size along proj, centred on the ink
+	# the ink spans from where the cumulative count passes q to where it passes 1 - q
+	cum = np.cumsum(proj)
+	if cum[-1] == 0:
+		return (len(proj) - size) / 2
+	lo, hi = np.searchsorted(cum, [q * cum[-1], (1 - q) * cum[-1]])
+	return (lo + hi + 1 - size) / 2
+
+
+def worker(args):
+	dir_in, dpi, i, rows, cols = args
+	unit = int((dpi / 300) * 256)
+	col_ink, row_ink = projections(f'{dir_in}/{i}.png')
+	x = best_offset(col_ink, cols * unit) / unit
+	y = best_offset(row_ink, rows * unit) / unit
+	return i, round(x, 3), round(y, 3)
+
+
+def main(dir_in, dpi, rows, cols, file_out, runner=None):
+	adj = load_adjustment(dir_in)
+	args = [(dir_in, dpi, i, rows, cols) for i in range(len(adj))]
+	with runner or Runner() as runner:
+		for i, x, y in runner.map(worker, args, label=lambda a: f'{a[2]}.png'):
+			print(f'{i}: x={x} y={y} (was x={adj[i]["x"]} y={adj[i]["y"]})')
+			adj[i]['x'] = x
+			adj[i]['y'] = y
+	#worker(args[0]) # debug
+	with open(file_out, 'w') as f:
+		json.dump(adj, f, indent=4)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		'dir_in',
+		type=str,
+		help='folder of scans e.g. scan/field_dpi300_rgba')
+	parser.add_argument(
+		'dpi',
+		type=int,
+		help='dpi of scans as determined by the scanner')
+	parser.add_argument(
+		'--rows',
+		type=int,
+		default=12,
+		help='rows in the grid')
+	parser.add_argument(
+		'--cols',
+		type=int,
+		default=18,
+		help='columns in the grid')
+	parser.add_argument(
+		'--apply',
+		action='store_true',
+		help='write the offsets to adjustment.json instead of adjustment_fit.json')
+	add_arguments(parser)
+	args = parser.parse_args()
+	main(
+		args.dir_in, args.dpi, args.rows, args.cols, 'adjustment.json' if args.apply else 'adjustment_fit.json',
+		Runner.from_args(args))
@@ -3,13 +3,17 @@ Creates copies of scans with a grid superimposed to show how they will be cut in
 The grid is offset by (x,y) values in adjustment.json.
 It needs to be centered over the drawing area.
 Edit adjustment.json directly to get the fit right for each scan.
-Use the --index flag to work a particular scan, otherwise they are all worked.
+Use the --index flag to work particular scans, otherwise they are all worked.
+Scans whose file and adjustment are unchanged since the last run are skipped.
+Use the --preview flag to draw the grid on a small copy of each scan, which is much faster.
 '''
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+from cache import Manifest, remove
 import json
 import os
 from PIL import Image, ImageDraw
+from runner import Runner, add_arguments, image_bytes
+from scan import ScanReader
 
 
 def load_adjustment(dir_in):
@@ -31,32 +35,62 @@ def load_adjustment(dir_in):
 
 
 def worker(args):
-	dir_in, dpi, dir_out, i, rows, cols, adj = args
+	dir_in, dpi, dir_out, i, rows, cols, adj, scale = args
 	filename = f'{i}.png'
 	unit = (dpi // 300) * 256
 	margin_x = adj[i]['x'] * unit
 	margin_y = adj[i]['y'] * unit
-	im = Image.open(f'{dir_in}/{filename}').convert('RGB')
+	if scale > 1:
+		# a preview, reduced as it is decoded, with the grid in scaled coordinates
+		im = ScanReader(f'{dir_in}/{filename}').reduced(scale).convert('RGB')
+		filepath = f'{dir_out}/preview/{filename}'
+	else:
+		im = Image.open(f'{dir_in}/{filename}').convert('RGB')
+		filepath = f'{dir_out}/{filename}'
 	draw = ImageDraw.Draw(im)
 	w, h = im.size
+	width = max(1, round(3 / scale))
 	for row in range(rows + 1):
-		y = margin_y + row * unit
-		draw.line([(0, y), (w, y)], fill=(255,0,0), width=3)
+		y = (margin_y + row * unit) / scale
+		draw.line([(0, y), (w, y)], fill=(255,0,0), width=width)
 	for col in range(cols + 1):
-		x = margin_x + col * unit
-		draw.line([(x, 0), (x, h)], fill=(255,0,0), width=3)
-	im.save(f'{dir_out}/{filename}')
+		x = (margin_x + col * unit) / scale
+		draw.line([(x, 0), (x, h)], fill=(255,0,0), width=width)
+	im.save(filepath)
 
 
-def main(dir_in, dpi, dir_out, index, rows, cols):
-	os.makedirs('grid', exist_ok=True)
+def main(dir_in, dpi, dir_out, index, rows, cols, force=False, scale=1, runner=None):
+	os.makedirs(dir_out, exist_ok=True)
 	adj = load_adjustment(dir_in)
+	manifest = Manifest(f'{dir_out}/cache.json', force)
 	if index:
-		args = [(dir_in, dpi, dir_out, index, rows, cols, adj)]
+		pages = index
+	else:
+		pages = range(len(adj))
+	# previews are cached apart from the full size grids
+	if scale > 1:
+		os.makedirs(f'{dir_out}/preview', exist_ok=True)
+		prefix = 'preview/'
 	else:
-		args = [(dir_in, dpi, dir_out, i, rows, cols, adj) for i in range(len(adj))]
-	with ProcessPoolExecutor() as executor:
-		executor.map(worker, args)
+		prefix = ''
+	args = []
+	keys = {}
+	for i in pages:
+		params = {'dpi': dpi, 'rows': rows, 'cols': cols, 'adjustment': adj[i], 'scale': scale}
+		key = manifest.key(f'{dir_in}/{i}.png', params)
+		outputs = [f'{dir_out}/{prefix}{i}.png']
+		if manifest.fresh(f'{prefix}{i}', key, outputs):
+			continue
+		remove(outputs)
+		keys[i] = key
+		args.append((dir_in, dpi, dir_out, i, rows, cols, adj, scale))
+	# each scan is held decoded, or reduced by scale for a preview
+	cost = lambda a: image_bytes(f'{dir_in}/{a[3]}.png') // scale**2
+	with runner or Runner() as runner:
+		for a, _, error in runner.completed(worker, args, cost, lambda a: f'{a[3]}.png'):
+			# a scan that fails is reported and left for the next run
+			if not error:
+				manifest.done(f'{prefix}{a[3]}', keys[a[3]])
 	#worker(args[0]) # debug
 
 
@@ -78,8 +112,9 @@ if __name__ == '__main__':
 	parser.add_argument(
 		'--index',
 		type=int,
+		nargs='+',
 		default=None,
-		help='specify a specific index to work')
+		help='specify the indices to work')
 	parser.add_argument(
 		'--rows',
 		type=int,
@@ -90,8 +125,19 @@ if __name__ == '__main__':
 		type=int,
 		default=18,
 		help='columns in the grid')
+	parser.add_argument(
+		'--force',
+		action='store_true',
+		help='work every scan, even those unchanged since the last run')
+	parser.add_argument(
+		'--preview',
+		type=int,
+		choices=[2, 4, 8, 16, 32],
+		default=1,
+		help='scale the scans down by this factor and save to {dir_out}/preview')
+	add_arguments(parser)
 	args = parser.parse_args()
-	main(args.dir_in, args.dpi, args.dir_out, args.index, args.rows, args.cols)
+	main(args.dir_in, args.dpi, args.dir_out, args.index, args.rows, args.cols, args.force, args.preview, Runner.from_args(args))
 
 
 
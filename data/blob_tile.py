@@ -3,22 +3,92 @@ Makes .png images, i.e. cuts tiles, of a standard size for training.
 For each scan, tiles are evenly spaced on a grid.
 Each tile is rotated at a random angle and perchance flipped.
 This only works for source material that need not preserve asymmetric features.
+Pages whose scan, adjustment and parameters are unchanged since the last run are skipped.
 '''
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+from background import BackgroundWriter, png_bytes
+from cache import Manifest, remove
+from collections import deque
+from container import open_writer
+import functools
+import glob
+from ink import InkIntegral, dark_pixels, summary
 import json
 import math
+from multiprocessing import shared_memory
+import numpy as np
 import os
 from PIL import Image
 import random
+from runner import Runner, add_arguments, image_bytes
+from scan import ScanReader
+from tfrecord import ShardWriter, record_digest
 import time
 
 Image.MAX_IMAGE_PIXELS = 277813800
 
 
-def worker(args):
-	i, adj, dir_in, dir_out, dpi, res, rows, cols, steps = args
+def rotation(theta):
+	t = math.radians(theta)
+	return round(math.cos(t), 15), round(math.sin(t), 15)
+
+
+def tile_matrix(x, y, theta, res):
+	# affine data for Image.transform, mapping each pixel of the tile to the page
+	# the tile is centred on (x, y) and rotated theta degrees counter clockwise,
+	# the same as Image.rotate on a scope centred on (x, y)
+	cos, sin = rotation(theta)
+	h = res / 2
+	return (
+		cos, -sin, x - cos * h + sin * h,
+		sin, cos, y - sin * h - cos * h)
+
+
+def cut_scope(img, x, y, theta, res, pad):
+	# crop an area large enough for the tile to rotate within
+	left = x - pad
+	right = x + pad
+	top = y - pad
+	bottom = y + pad
+	scope = img.crop((left, top, right, bottom))
+	scope = scope.rotate(theta)
+
+	# cut the tile
+	tx = scope.width / 2
+	ty = scope.height / 2
+	left = tx - (res / 2)
+	right = tx + (res / 2)
+	top = ty - (res / 2)
+	bottom = ty + (res / 2)
+	return scope.crop((left, top, right, bottom))
+
+
+def cut_affine(img, x, y, theta, res):
+	# sample the tile straight from the page in one resample
+	return img.transform((res, res), Image.AFFINE, tile_matrix(x, y, theta, res))
 
+
+def rotate_point(x, y, centre, theta):
+	# where a point on the page lands when the page is rotated theta degrees about centre
+	# rotated coordinates have centre as the origin
+	cos, sin = rotation(theta)
+	dx = x - centre[0]
+	dy = y - centre[1]
+	return cos * dx + sin * dy, -sin * dx + cos * dy
+
+
+def rotate_window(img, top, centre, theta, window):
+	# render the window (left, top, right, bottom) of the page rotated about centre
+	# img holds the page from row top down
+	cos, sin = rotation(theta)
+	l, t, r, b = window
+	data = (
+		cos, -sin, cos * l - sin * t + centre[0],
+		sin, cos, sin * l + cos * t + centre[1] - top)
+	return img.transform((r - l, b - t), Image.AFFINE, data)
+
+
+def grid_box(adj, i, dpi, res, rows, cols, steps):
 	# tiles are cut within the grid set by grid.py
 	# each square in the grid is 1 unit
 	# 1 unit = 256 / 300 square inches
@@ -55,57 +125,346 @@ def worker(args):
 		int(adj_x + grid[0] - pad), # right
 		int(adj_y + grid[1] - pad) # bottom
 	]
+	return box, step, pad
 
-	os.makedirs(f'{dir_out}/{i}', exist_ok=True)
-	img = Image.open(f'{dir_in}/{i}.png')
-
-	# iterate through every row and column
-	count = 0
-	for y in range(box[1], box[3], step):
-		for x in range(box[0], box[2], step):
-			# crop an area large enough for the tile to rotate within
-			left = x - pad
-			right = x + pad
-			top = y - pad
-			bottom = y + pad
-			scope = img.crop((left, top, right, bottom))
 
+def plan_band(box, step, r0, r1, seed, i, extract, angles):
+	# every tile in rows r0 to r1 of the grid
+	# each tile draws from its own generator, seeded by page and tile number,
+	# so the output does not depend on which worker cuts it
+	xs = range(box[0], box[2], step)
+	ys = range(box[1], box[3], step)
+	plan = []
+	for r in range(r0, r1):
+		for c, x in enumerate(xs):
+			count = r * len(xs) + c
+			rng = random.Random(f'{seed}/{i}/{count}')
 			# rotate and flip randomly
-			theta = random.randrange(360)
-			scope = scope.rotate(theta)
-			if random.randrange(1) == 1:
-				scope = scope.transpose.TRANSPOSE
+			if extract == 'quantized':
+				theta = rng.randrange(angles) * 360 / angles
+			else:
+				theta = rng.randrange(360)
+			flip = rng.randrange(1) == 1
+			plan.append((count, x, ys[r], theta, flip))
+	return plan
+
+
+def load_page(filepath):
+	# decode the scan once into shared memory for all workers to read
+	# it is read a band at a time, so there is never a second copy of the page
+	# the ink of the page is counted on the way
+	reader = ScanReader(filepath)
+	mode = reader.mode if reader.mode in ('L', 'RGB', 'RGBA') else 'RGB'
+	c = len(mode) # one letter per channel
+	w, h = reader.size
+	shape = (h, w, c) if c > 1 else (h, w)
+	shm = shared_memory.SharedMemory(create=True, size=h * w * c)
+	page = None
+	try:
+		page = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+		ink = InkIntegral(reader.size)
+		for top, band in reader.bands():
+			if band.mode != mode:
+				band = band.convert(mode)
+			page[top:top + band.height] = np.asarray(band)
+			ink.add(top, dark_pixels(band))
+		del page
+	except BaseException:
+		# a scan that fails to decode frees its shared memory, once no array holds it
+		page = None
+		free(shm)
+		raise
+	return shm, shape, ink
+
+
+def tile_coverage(ink, box, step, res):
+	# ink coverage of every tile centre in the grid, rows by columns
+	# measured in the square in the middle of the tile that stays inside it at any angle
+	xs = np.arange(box[0], box[2], step)
+	ys = np.arange(box[1], box[3], step)
+	h = res / (2 * math.sqrt(2))
+	x, y = np.meshgrid(xs, ys)
+	return ink.coverage(x - h, y - h, x + h, y + h)
+
+
+def read_band(name, shape, top, bottom):
+	# copy rows top to bottom of a page in shared memory
+	shm = shared_memory.SharedMemory(name=name)
+	try:
+		page = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+		band = page[top:bottom].copy()
+		del page
+	finally:
+		shm.close()
+	return Image.fromarray(band)
+
+
+def res_dirs(opt):
+	# output folder for each resolution
+	# with several resolutions each gets a subfolder of dir_out
+	if len(opt.resolution) == 1:
+		return {opt.resolution[0]: opt.dir_out}
+	return {r: f'{opt.dir_out}/{r}' for r in opt.resolution}
+
+
+def encode_record(im, shape, compress_level):
+	# the .png bytes of a tile, and the digest of its record as tfrecord.py lists it
+	data = png_bytes(im, compress_level)
+	return data, record_digest(data, shape)
+
+
+def write_record(writer, shards, source, shape, encoded):
+	# shards lists the records of each shard as the manifest.json of tfrecord.py does
+	# a tile has no source file of its own, so only its name and digest are listed
+	data, digest = encoded
+	name, _ = writer.write(data, shape)
+	shard = shards.setdefault(name, {'count': 0, 'tiles': []})
+	shard['count'] += 1
+	shard['tiles'].append([source, digest, None, None, None])
+
+
+def worker(args):
+	# returns the records written to each resolution's shards, with --format tfrecord
+	i, adj, opt, seed, page, band, keep = args
+	# tiles are cut at the largest resolution, and reduced to the others
+	res = max(opt.resolution)
+	box, step, pad = grid_box(adj, i, opt.dpi, res, opt.rows, opt.cols, opt.steps)
+	r0, r1 = band
+	plan = plan_band(box, step, r0, r1, seed, i, opt.extract, opt.angles)
+	# tiles of mostly paper are dropped before they are cut, keeping the numbering of the rest
+	cols = keep.shape[1]
+	plan = [t for t in plan if keep[t[0] // cols - r0, t[0] % cols]]
+
+	# only the rows of the page that the band's tiles can reach
+	name, shape = page
+	ys = range(box[1], box[3], step)
+	top = max(math.floor(ys[r0] - pad) - 1, 0)
+	bottom = min(math.ceil(ys[r1 - 1] + pad) + 2, shape[0])
+	img = read_band(name, shape, top, bottom)
+
+	# tiles go to .png files, straight into this band's .tfrecord shards,
+	# or into one .tar or .npy container for the band
+	dirs = res_dirs(opt)
+	writers = {}
+	shards = {r: {} for r in dirs}
+	# the writers are closed, and tiles still queued are dropped, even if the band fails
+	try:
+		for r, d in dirs.items():
+			if opt.format == 'tfrecord':
+				writers[r] = ShardWriter(d, f'{i}_{r0:04}', opt.size)
+			elif opt.format != 'png':
+				writers[r] = open_writer(f'{d}/{i}_{r0:04}.{opt.format}', compress_level=opt.compress_level)
+		# tiles are encoded on the writer threads while the next ones are cut
+		with BackgroundWriter(opt.writer_threads) as background:
+			def save(count, tile, flip):
+				if flip:
+					tile = tile.transpose(Image.Transpose.TRANSPOSE)
+				for r, d in dirs.items():
+					out = tile if r == res else tile.reduce(res // r)
+					if opt.format == 'tfrecord':
+						shape = (r, r, len(out.getbands()))
+						background.put(
+							functools.partial(encode_record, out, shape, opt.compress_level),
+							functools.partial(write_record, writers[r], shards[r], f'{i}/{count}.png', shape))
+					elif writers:
+						# named as the .png file would be
+						background.put(
+							functools.partial(writers[r].encode, out),
+							functools.partial(writers[r].write_encoded, f'{i}/{count}.png'))
+					else:
+						background.put(functools.partial(out.save, f'{d}/{i}/{count}.png', compress_level=opt.compress_level))
+
+			if opt.extract == 'quantized':
+				# rotate the band once per angle and reuse it for every tile at that angle
+				# the rotated page is rendered in blocks on a lattice about the centre of the grid,
+				# the same for every band, so a tile is cut the same whichever band it falls in
+				centre = ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2)
+				for theta in sorted(set(t[3] for t in plan)):
+					blocks = {}
+					for count, x, y, t, flip in plan:
+						if t != theta:
+							continue
+						qx, qy = rotate_point(x, y, centre, theta)
+						left = round(qx - res / 2)
+						upper = round(qy - res / 2)
+						tile = Image.new(img.mode, (res, res))
+						for by in range(upper // res, (upper + res - 1) // res + 1):
+							for bx in range(left // res, (left + res - 1) // res + 1):
+								if (bx, by) not in blocks:
+									window = (bx * res, by * res, (bx + 1) * res, (by + 1) * res)
+									blocks[(bx, by)] = rotate_window(img, top, centre, theta, window)
+								tile.paste(blocks[(bx, by)], (bx * res - left, by * res - upper))
+						save(count, tile, flip)
+			else:
+				for count, x, y, theta, flip in plan:
+					if opt.extract == 'affine':
+						tile = cut_affine(img, x, y - top, theta, res)
+					else:
+						tile = cut_scope(img, x, y - top, theta, res, pad)
+					save(count, tile, flip)
+	finally:
+		for writer in writers.values():
+			writer.close()
+	return shards if opt.format == 'tfrecord' else None
 
-			# cut the tile
-			tx = scope.width / 2
-			ty = scope.height / 2
-			left = tx - (res / 2)
-			right = tx + (res / 2)
-			top = ty - (res / 2)
-			bottom = ty + (res / 2)
-			tile = scope.crop((left, top, right, bottom))
 
-			tile.save(f'{dir_out}/{i}/{count}.png')
-			count += 1
+def free(shm):
+	shm.close()
+	shm.unlink()
+
+
+def finish(page, manifest, runner, records=None):
+	# wait for every band of a page, then free its shared memory
+	# a page with a band that failed is reported and left for the next run
+	# with --format tfrecord, records gains the shards of each band, by resolution
+	shm, futures, i, key, _ = page
+	failed = False
+	results = []
+	try:
+		for future in futures:
+			try:
+				results.append(runner.result(future))
+			except Exception:
+				failed = True
+	finally:
+		free(shm)
+	if not failed:
+		if records is not None:
+			for shards in results:
+				for r, s in shards.items():
+					records[r].update(s)
+		manifest.done(str(i), key)
+
+
+def load_records(dirs):
+	# the shards listed in the manifest.json of each resolution's folder
+	records = {}
+	for r, d in dirs.items():
+		records[r] = {}
+		if os.path.exists(f'{d}/manifest.json'):
+			with open(f'{d}/manifest.json', 'r') as f:
+				records[r] = json.load(f)['shards']
+	return records
+
+
+def write_records(dirs, records, seed):
+	# a manifest.json in each resolution's folder, as tfrecord.py writes, for tfrecord_reverse.py --verify
+	# shards whose file is gone, e.g. of a page no longer in adjustment.json, are dropped
+	for r, d in dirs.items():
+		shards = {name: s for name, s in sorted(records[r].items()) if os.path.exists(f'{d}/{name}')}
+		tmp = f'{d}/manifest.json.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'seeds': [seed], 'digest': 'record', 'shards': shards}, f)
+		os.replace(tmp, f'{d}/manifest.json')
+
+
+def page_params(args, adj, i, seed):
+	# everything that shapes the tiles of page i
+	params = {
+		'dpi': args.dpi,
+		# a single resolution keys as before, so earlier runs stay valid
+		'resolution': args.resolution[0] if len(args.resolution) == 1 else sorted(set(args.resolution)),
+		'rows': args.rows,
+		'cols': args.cols,
+		'steps': args.steps,
+		'extract': args.extract,
+		'format': args.format,
+		'seed': seed,
+		'min_ink': args.min_ink,
+		'adjustment': adj[i]
+	}
+	if args.extract == 'quantized':
+		params['angles'] = args.angles
+	if args.format == 'tfrecord':
+		params['size'] = args.size
+	return params
+
+
+def page_outputs(args, i):
+	dirs = res_dirs(args).values()
+	if args.format == 'png':
+		return [f'{d}/{i}' for d in dirs]
+	return sorted(p for d in dirs for p in glob.glob(f'{d}/{i}_*.{args.format}*'))
 
 
 def main(args):
 	with open('adjustment.json', 'r') as json_file:
 		adj = json.load(json_file)
-	args = [(
-		i,
-		adj,
-		args.dir_in,
-		args.dir_out,
-		args.dpi,
-		args.resolution,
-		args.rows,
-		args.cols,
-		args.steps
-	) for i in range(len(adj))]
-	with ProcessPoolExecutor() as executor:
-		executor.map(worker, args)
-	#worker(args[0]) # debug
+	res = max(args.resolution)
+	for d in res_dirs(args).values():
+		os.makedirs(d, exist_ok=True)
+	manifest = Manifest(f'{args.dir_out}/cache.json', args.force)
+	# without --seed, the seed of the last run is kept so its tiles stay valid
+	seed = args.seed
+	if seed is None:
+		seed = manifest.seed
+	if seed is None:
+		seed = random.randrange(2**32)
+	manifest.seed = seed
+	print('seed:', seed)
+	# with --format tfrecord, the records of each resolution's shards, for its manifest.json
+	dirs = res_dirs(args)
+	records = load_records(dirs) if args.format == 'tfrecord' else None
+
+	def done(page):
+		finish(page, manifest, runner, records)
+		if records is not None:
+			write_records(dirs, records, seed)
+
+	# pages decoded into shared memory whose bands are not all done
+	pending = deque()
+	try:
+		with Runner.from_args(args) as runner:
+			# one page is decoded while the bands of the previous page are cut
+			# with --memory, as many pages as fit in it are decoded ahead instead
+			for i in range(len(adj)):
+				box, step, pad = grid_box(adj, i, args.dpi, res, args.rows, args.cols, args.steps)
+				n = len(range(box[1], box[3], step))
+				if n == 0:
+					continue
+				filepath = f'{args.dir_in}/{i}.png'
+				key = manifest.key(filepath, page_params(args, adj, i, seed))
+				outputs = page_outputs(args, i)
+				if manifest.fresh(str(i), key, outputs):
+					continue
+				remove(outputs)
+				if records is not None:
+					for shards in records.values():
+						for name in [n for n in shards if n.startswith(f'{i}_')]:
+							del shards[name]
+				if args.format == 'png':
+					for d in res_dirs(args).values():
+						os.makedirs(f'{d}/{i}', exist_ok=True)
+				band = args.band or max(1, math.ceil(n / runner.workers))
+				nbytes = image_bytes(filepath)
+				while pending and (
+					len(pending) > 1 if runner.budget is None else
+					sum(p[4] for p in pending) + nbytes > runner.budget):
+					done(pending.popleft())
+				shm, shape, ink = load_page(filepath)
+				futures = []
+				pending.append((shm, futures, i, key, nbytes))
+				coverage = tile_coverage(ink, box, step, res)
+				keep = coverage >= args.min_ink
+				print(f'{i}: {summary(coverage, keep)}')
+				tasks = [(
+					i,
+					adj,
+					args,
+					seed,
+					(shm.name, shape),
+					(r, min(r + band, n)),
+					keep[r:r + band]
+				) for r in range(0, n, band)]
+				futures.extend(runner.submit(worker, t, f'{i} rows {t[5][0]}:{t[5][1]}') for t in tasks)
+				#worker(tasks[0]) # debug
+			while pending:
+				done(pending.popleft())
+	finally:
+		# pages left after an error, e.g. a scan in adjustment.json that is missing, still free their shared memory
+		# the runner has stopped by now, so no worker is reading them
+		for page in pending:
+			free(page[0])
 
 
 if __name__ == '__main__':
@@ -123,8 +482,10 @@ if __name__ == '__main__':
 	parser.add_argument(
 		'resolution',
 		type=int,
+		nargs='+',
 		choices=[4, 8, 16, 32, 64, 128, 256, 512, 1024],
-		help='how many square pixels each tile will have. power of 2 between 4 and 1024')
+		help='how many square pixels each tile will have. power of 2 between 4 and 1024. ' +
+		'with several, tiles are cut once at the largest and reduced to the others, each in a subfolder of dir_out')
 	parser.add_argument(
 		'--dir_out',
 		type=str,
@@ -146,6 +507,63 @@ if __name__ == '__main__':
 		default=2,
 		help='positive integer. inverse of the fraction that tiles overlap.' +
 		'more steps -> more overlap. value of 1 means they don\'t overlap.')
+	parser.add_argument(
+		'--extract',
+		type=str,
+		choices=['affine', 'quantized', 'scope'],
+		default='affine',
+		help='affine: sample each tile from the page in one transform. ' +
+		'quantized: rotate the page once per angle in --angles and crop the tiles from it. ' +
+		'scope: crop, rotate and crop again')
+	parser.add_argument(
+		'--angles',
+		type=int,
+		default=16,
+		help='number of evenly spaced angles used by --extract=quantized')
+	parser.add_argument(
+		'--band',
+		type=int,
+		default=None,
+		help='rows of tiles per task. by default each page is split evenly across the cpus')
+	parser.add_argument(
+		'--seed',
+		type=int,
+		default=None,
+		help='seed for the angle of each tile. the same seed cuts the same tiles')
+	parser.add_argument(
+		'--format',
+		type=str,
+		choices=['png', 'tfrecord', 'tar', 'npy'],
+		default='png',
+		help='png: one file per tile in a subfolder per page. ' +
+		'tfrecord: tiles are written straight to .tfrecord shards, as made by tfrecord.py, with a manifest.json for tfrecord_reverse.py --verify. ' +
+		'tar: a .tar of the .png files per band. npy: a uint8 .npy stack of the tiles per band, with an index')
+	parser.add_argument(
+		'--size',
+		type=int,
+		default=300000000,
+		help='maximum .tfrecord size in bytes for --format=tfrecord')
+	parser.add_argument(
+		'--min_ink',
+		type=float,
+		default=0,
+		help='skip tiles whose middle has less than this fraction of dark pixels, e.g. 0.01')
+	parser.add_argument(
+		'--compress_level',
+		type=int,
+		choices=range(10),
+		default=6,
+		help='zlib level of the .png tiles, 0 to 9. lower is faster and larger, e.g. 1 for tiles only read by tfrecord.py')
+	parser.add_argument(
+		'--writer_threads',
+		type=int,
+		default=2,
+		help='threads per worker that encode tiles while the next are cut. 0 encodes each tile as it is cut')
+	parser.add_argument(
+		'--force',
+		action='store_true',
+		help='cut every page, even those unchanged since the last run')
+	add_arguments(parser)
 
 	args = parser.parse_args()
 	main(args)
@@ -0,0 +1,78 @@
+'''
+A manifest of the pages a script has already worked, so the next run can skip them.
+Each page is keyed by the hash of its scan together with the parameters that shape its output,
+e.g. its entry in adjustment.json, dpi and resolution.
+A page is worked again only when its key changes or its output is gone.
+The manifest is saved as each page is finished, so an interrupted run resumes where it stopped.
+'''
+import hashlib
+import json
+import os
+import shutil
+
+
+def file_digest(filepath, block=1 << 20):
+	h = hashlib.blake2b(digest_size=16)
+	with open(filepath, 'rb') as f:
+		while True:
+			data = f.read(block)
+			if not data:
+				break
+			h.update(data)
+	return h.hexdigest()
+
+
+def remove(paths):
+	# clear the stale output of a page before it is worked again
+	for path in paths:
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		elif os.path.exists(path):
+			os.remove(path)
+
+
+class Manifest:
+	def __init__(self, filepath, force=False):
+		self.filepath = filepath
+		self.scans = {} # scan path: [size, mtime, digest]
+		self.pages = {} # page: key
+		self.seed = None
+		# with force every page is worked, and the manifest starts over
+		if not force and os.path.exists(filepath):
+			with open(filepath, 'r') as f:
+				data = json.load(f)
+			self.scans = data['scans']
+			self.pages = data['pages']
+			self.seed = data.get('seed')
+
+	def digest(self, scan):
+		# a scan is only hashed again if its size or modification time changed
+		st = os.stat(scan)
+		stat = [st.st_size, st.st_mtime_ns]
+		entry = self.scans.get(scan)
+		if entry and entry[:2] == stat:
+			return entry[2]
+		digest = file_digest(scan)
+		self.scans[scan] = stat + [digest]
+		return digest
+
+	def key(self, scan, params):
+		h = hashlib.blake2b(digest_size=16)
+		h.update(self.digest(scan).encode())
+		h.update(json.dumps(params, sort_keys=True).encode())
+		return h.hexdigest()
+
+	def fresh(self, page, key, outputs):
+		# the page was worked with the same key and its output is still there
+		return self.pages.get(page) == key and len(outputs) > 0 and all(os.path.exists(p) for p in outputs)
+
+	def done(self, page, key):
+		self.pages[page] = key
+		self.save()
+
+	def save(self):
+		# write then rename, so an interruption never leaves half a manifest
+		tmp = f'{self.filepath}.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({'seed': self.seed, 'scans': self.scans, 'pages': self.pages}, f, indent=4)
+		os.replace(tmp, self.filepath)
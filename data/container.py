@@ -0,0 +1,163 @@
+'''
+Writes tiles to a few sequential containers instead of one .png file each.
+- .tar: the .png files, named as they would be on disk, e.g. 0/12.png
+- .npy: a uint8 stack of tiles of one shape (count, height, width, channels),
+  with an index of their names, {file}.index
+Either is written front to back, and a tile is read from its offset without listing a folder.
+'''
+from background import COMPRESS_LEVEL, png_bytes
+import io
+import json
+import numpy as np
+import os
+from PIL import Image
+import struct
+import tarfile
+import time
+
+EXTENSIONS = ('.tar', '.npy')
+NPY_HEADER = 128 # bytes, room for any count
+
+
+def is_container(filename):
+	return filename.endswith(EXTENSIONS)
+
+
+def index_path(path):
+	return f'{path}.index'
+
+
+def tile_array(im):
+	# shape (height, width, channels), as the tile would be decoded for training
+	a = np.asarray(im, dtype=np.uint8)
+	return a[:, :, np.newaxis] if a.ndim == 2 else a
+
+
+def npy_header(shape):
+	# a version 1.0 .npy header padded to a fixed length,
+	# so it can be written again once the count is known
+	header = repr({'descr': '|u1', 'fortran_order': False, 'shape': tuple(shape)}).encode('latin1')
+	header += b' ' * (NPY_HEADER - 10 - len(header) - 1) + b'\n'
+	return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+
+# encode() may run on a writer thread, and write_encoded() then stores its result in order
+
+class TarWriter:
+	def __init__(self, path, compress_level=COMPRESS_LEVEL):
+		self.path = path
+		self.tar = tarfile.open(path, 'w')
+		self.compress_level = compress_level
+
+	def write(self, name, im):
+		self.write_encoded(name, self.encode(im))
+
+	def encode(self, im):
+		return png_bytes(im, self.compress_level)
+
+	def write_encoded(self, name, data):
+		info = tarfile.TarInfo(name)
+		info.size = len(data)
+		info.mtime = int(time.time())
+		self.tar.addfile(info, io.BytesIO(data))
+
+	def close(self):
+		self.tar.close()
+
+
+class NpyWriter:
+	def __init__(self, path):
+		self.path = path
+		self.f = open(path, 'wb')
+		self.f.write(npy_header((0,)))
+		self.shape = None
+		self.names = []
+
+	def write(self, name, im):
+		self.write_encoded(name, self.encode(im))
+
+	def encode(self, im):
+		return tile_array(im)
+
+	def write_encoded(self, name, a):
+		if self.shape is None:
+			self.shape = a.shape
+		elif a.shape != self.shape:
+			raise ValueError(f'{self.path}: tile {name} has shape {a.shape}, not {self.shape}')
+		self.f.write(np.ascontiguousarray(a, dtype=np.uint8).tobytes())
+		self.names.append(name)
+
+	def close(self):
+		shape = (len(self.names),) + (self.shape or ())
+		self.f.seek(0)
+		self.f.write(npy_header(shape))
+		self.f.close()
+		with open(index_path(self.path), 'w') as f:
+			json.dump({'count': len(self.names), 'shape': list(shape), 'names': self.names}, f)
+
+
+def open_writer(path, ext=None, compress_level=COMPRESS_LEVEL):
+	# ext is the kind of container, if path does not end in it
+	# compress_level is for the .png files in a .tar, a .npy is not compressed
+	if (ext or os.path.splitext(path)[1]) == '.tar':
+		return TarWriter(path, compress_level)
+	return NpyWriter(path)
+
+
+def paths(path):
+	# the files of a container, for clearing stale output
+	return [path, index_path(path)] if path.endswith('.npy') else [path]
+
+
+class ContainerReader:
+	# read() returns the .png bytes of a tile in a .tar, or its array in a .npy
+	def __init__(self, path):
+		self.path = path
+		if path.endswith('.tar'):
+			# only the member headers are read, to find where each .png is
+			with tarfile.open(path) as tar:
+				self.members = {m.name: (m.offset_data, m.size) for m in tar.getmembers() if m.isfile()}
+			self.f = open(path, 'rb')
+			self.stack = None
+		else:
+			with open(index_path(path), 'r') as f:
+				names = json.load(f)['names']
+			self.members = {name: k for k, name in enumerate(names)}
+			self.f = None
+			self.stack = np.load(path, mmap_mode='r') if names else None
+
+	def names(self):
+		return list(self.members)
+
+	def read(self, name):
+		if self.f:
+			offset, size = self.members[name]
+			self.f.seek(offset)
+			return self.f.read(size)
+		return np.array(self.stack[self.members[name]])
+
+	def image(self, name):
+		data = self.read(name)
+		if isinstance(data, bytes):
+			im = Image.open(io.BytesIO(data))
+			im.load()
+			return im
+		return Image.fromarray(data[:, :, 0] if data.shape[-1] == 1 else data)
+
+	def close(self):
+		if self.f:
+			self.f.close()
+		self.stack = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def replace(tmp, path):
+	# a container rewritten to tmp takes the place of path, with its index
+	os.replace(tmp, path)
+	if path.endswith('.npy'):
+		os.replace(index_path(tmp), index_path(path))
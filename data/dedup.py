@@ -0,0 +1,118 @@
+'''
+Removes tiles that look nearly the same as a tile already kept,
+e.g. the heavily overlapping tiles of blob_tile.py with many --steps.
+Each tile gets a 64 bit perceptual hash, from the low frequencies of its discrete cosine transform.
+Tiles are near duplicates if their hashes differ in at most --distance bits.
+The hashes are found in a multi-index: they are cut into distance + 1 parts,
+and two hashes within the distance must match exactly on at least one part,
+so a tile is only compared with the kept tiles that share a part with it.
+dir_in follows the folder tree created by the tile scripts, i.e. 1 layer of subfolders.
+'''
+import argparse
+import numpy as np
+import os
+from PIL import Image
+from runner import Runner, add_arguments
+
+N = 32 # side of the image the transform is taken of
+DCT = np.cos(np.pi * np.outer(np.arange(N), 2 * np.arange(N) + 1) / (2 * N))
+
+
+def phash(im):
+	# signs of the 8x8 lowest frequencies against their median
+	px = np.asarray(im.convert('L').resize((N, N), Image.Resampling.BOX), dtype=np.float64)
+	low = (DCT @ px @ DCT.T)[:8, :8]
+	bits = (low > np.median(low)).flatten()
+	return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class HashIndex:
+	# the kept hashes, looked up by each of their parts
+	def __init__(self, distance, bits=64):
+		m = distance + 1
+		bounds = [round(bits * j / m) for j in range(m + 1)]
+		self.parts = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds[:-1], bounds[1:])]
+		self.tables = [{} for _ in self.parts]
+		self.distance = distance
+
+	def near(self, h):
+		# whether a kept hash is within the distance of h
+		for (shift, mask), table in zip(self.parts, self.tables):
+			for other in table.get((h >> shift) & mask, ()):
+				if bin(h ^ other).count('1') <= self.distance:
+					return True
+		return False
+
+	def add(self, h):
+		for (shift, mask), table in zip(self.parts, self.tables):
+			table.setdefault((h >> shift) & mask, []).append(h)
+
+
+def tile_order(filename):
+	# 2.png before 10.png
+	return (len(filename), filename)
+
+
+def worker(args):
+	# hash of each tile in a subfolder
+	dir_in, subdir = args
+	hashes = []
+	for filename in sorted(os.listdir(f'{dir_in}/{subdir}'), key=tile_order):
+		with Image.open(f'{dir_in}/{subdir}/{filename}') as im:
+			hashes.append((filename, phash(im)))
+	return subdir, hashes
+
+
+def main(dir_in, distance, scope, dry_run, runner=None):
+	# subfolders only, not e.g. the cache.json of the tile scripts
+	subdirs = sorted((d for d in os.listdir(dir_in) if os.path.isdir(f'{dir_in}/{d}')), key=tile_order)
+	args = [(dir_in, subdir) for subdir in subdirs]
+	index = HashIndex(distance)
+	total = 0
+	removed = 0
+	with runner or Runner() as runner:
+		for subdir, hashes in runner.map(worker, args, label=lambda a: a[1]):
+			# with scope page, tiles are only compared within their page
+			if scope == 'page':
+				index = HashIndex(distance)
+			n = 0
+			for filename, h in hashes:
+				if index.near(h):
+					n += 1
+					if not dry_run:
+						os.remove(f'{dir_in}/{subdir}/{filename}')
+				else:
+					index.add(h)
+			print(f'{subdir}: {n} of {len(hashes)} removed')
+			total += len(hashes)
+			removed += n
+	#worker(args[0]) # debug
+	print(f'total: {removed} of {total} removed')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		'dir_in',
+		type=str,
+		help='folder of tiles e.g. tile')
+	parser.add_argument(
+		'--distance',
+		type=int,
+		default=4,
+		help='tiles whose hashes differ in this many bits or fewer are near duplicates. between 0 and 15')
+	parser.add_argument(
+		'--scope',
+		type=str,
+		choices=['page', 'dataset'],
+		default='page',
+		help='page: compare tiles within each subfolder. dataset: compare every tile with every other')
+	parser.add_argument(
+		'--dry_run',
+		action='store_true',
+		help='only report how many tiles would be removed')
+	add_arguments(parser)
+	args = parser.parse_args()
+	if not 0 <= args.distance <= 15:
+		parser.error('--distance must be between 0 and 15')
+	main(args.dir_in, args.distance, args.scope, args.dry_run, Runner.from_args(args))
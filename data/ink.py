@@ -0,0 +1,53 @@
+'''
+How much of a box on a page is ink, from an integral image of the page's dark pixels.
+Dark pixels are counted in blocks of 8x8 pixels, so the integral image stays small at 1200 dpi,
+and the ink in any box takes 4 lookups, read to the nearest block.
+Tiles that are almost all paper can then be skipped before they are cut or encoded.
+'''
+import numpy as np
+
+
+def dark_pixels(img):
+	a = np.asarray(img.convert('RGB'), dtype=np.uint16)
+	return a.sum(axis=2) < 384
+
+
+class InkIntegral:
+	def __init__(self, size, block=8):
+		w, h = size
+		self.block = block
+		self.counts = np.zeros((-(-h // block), -(-w // block)), dtype=np.int64)
+		self.table = None
+
+	def add(self, top, dark):
+		# dark pixels of the rows from top, which starts on a block
+		b = self.block
+		dark = np.pad(dark, ((0, -dark.shape[0] % b), (0, -dark.shape[1] % b)))
+		blocks = dark.reshape(dark.shape[0] // b, b, dark.shape[1] // b, b).sum(axis=(1, 3))
+		self.counts[top // b:top // b + len(blocks), :blocks.shape[1]] += blocks
+		self.table = None
+
+	def coverage(self, l, t, r, b):
+		# fraction of dark pixels in each box (l, t, r, b), given as numbers or arrays
+		if self.table is None:
+			rows, cols = self.counts.shape
+			self.table = np.zeros((rows + 1, cols + 1), dtype=np.int64)
+			self.table[1:, 1:] = self.counts.cumsum(axis=0).cumsum(axis=1)
+		rows, cols = self.counts.shape
+		bx = lambda v, n: np.clip(np.rint(np.asarray(v) / self.block).astype(int), 0, n)
+		l, r = bx(l, cols), bx(r, cols)
+		t, b = bx(t, rows), bx(b, rows)
+		T = self.table
+		ink = T[b, r] - T[t, r] - T[b, l] + T[t, l]
+		area = (r - l) * (b - t) * self.block**2
+		return np.where(area > 0, ink / np.maximum(area, 1), 0.0)
+
+
+def summary(coverage, keep):
+	# e.g. 120 of 216 tiles kept. ink coverage min 0.000 median 0.041 max 0.210
+	coverage = np.asarray(coverage)
+	if coverage.size == 0:
+		return '0 tiles'
+	return (
+		f'{int(np.sum(keep))} of {coverage.size} tiles kept. ink coverage ' +
+		f'min {coverage.min():.3f} median {np.median(coverage):.3f} max {coverage.max():.3f}')
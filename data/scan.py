@@ -0,0 +1,191 @@
+'''
+Reads and writes .png scans a band of rows at a time,
+so a worker never holds more of a page than the rows it is working on.
+A band is decoded by handing Pillow a small .png made of the band's rows,
+preceded by the last row of the band before it, which the PNG filters refer to.
+Scans that can't be split this way (interlaced, palette, 16-bit) are decoded whole.
+'''
+import io
+import numpy as np
+from PIL import Image
+import struct
+import zlib
+
+Image.MAX_IMAGE_PIXELS = 277813800
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# color type: mode, channels
+COLOR_TYPES = {
+	0: ('L', 1),
+	2: ('RGB', 3),
+	4: ('LA', 2),
+	6: ('RGBA', 4)
+}
+
+
+def chunk(chunk_type, data):
+	crc = zlib.crc32(chunk_type + data)
+	return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def ihdr(w, h, color_type):
+	# 8 bits per channel, no interlace
+	return chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, color_type, 0, 0, 0))
+
+
+def idat_pieces(f, piece_size=1 << 16):
+	# yield the compressed image data in pieces, whatever the size of the IDAT chunks
+	while True:
+		header = f.read(8)
+		if len(header) < 8:
+			return
+		length, chunk_type = struct.unpack('>I4s', header)
+		if chunk_type == b'IDAT':
+			while length > 0:
+				piece = f.read(min(length, piece_size))
+				length -= len(piece)
+				yield piece
+		elif chunk_type == b'IEND':
+			return
+		else:
+			f.seek(length, 1)
+		f.seek(4, 1) # crc
+
+
+class ScanReader:
+	def __init__(self, filepath, band=256):
+		self.filepath = filepath
+		self.band = band
+		with open(filepath, 'rb') as f:
+			header = f.read(33)
+		if header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+			raise ValueError(f'{filepath} is not a .png')
+		w, h, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', header[16:29])
+		self.size = (w, h)
+		self.width = w
+		self.height = h
+		self.color_type = color_type
+		self.streamable = depth == 8 and color_type in COLOR_TYPES and interlace == 0
+		if self.streamable:
+			self.mode, self.channels = COLOR_TYPES[color_type]
+		else:
+			self.mode = Image.open(filepath).mode
+		self.cache = []
+		self.source = None
+
+	def bands(self):
+		# yield (top, image) for each band of rows, top to bottom
+		w, h = self.size
+		if not self.streamable:
+			img = Image.open(self.filepath)
+			img.load()
+			for top in range(0, h, self.band):
+				yield top, img.crop((0, top, w, min(top + self.band, h)))
+			return
+		row_bytes = 1 + w * self.channels # filter type and pixels
+		# the row above the first is all zero
+		prior = bytes(row_bytes)
+		decompress = zlib.decompressobj()
+		buf = bytearray()
+		top = 0
+		with open(self.filepath, 'rb') as f:
+			f.seek(8)
+			for piece in idat_pieces(f):
+				while piece:
+					buf += decompress.decompress(piece, row_bytes * self.band)
+					piece = decompress.unconsumed_tail
+					while len(buf) >= row_bytes * self.band and top < h:
+						n = min(self.band, h - top)
+						image, prior = self.decode(prior, buf, n)
+						del buf[:row_bytes * n]
+						yield top, image
+						top += n
+			buf += decompress.flush()
+		while top < h:
+			n = min(self.band, h - top, len(buf) // row_bytes)
+			if n == 0:
+				raise ValueError(f'{self.filepath} is truncated at row {top}')
+			image, prior = self.decode(prior, buf, n)
+			del buf[:row_bytes * n]
+			yield top, image
+			top += n
+
+	def decode(self, prior, buf, n):
+		# decode n rows of filtered data that follow the unfiltered row prior
+		w = self.width
+		data = prior + bytes(buf[:(1 + w * self.channels) * n])
+		png = (
+			PNG_SIGNATURE +
+			ihdr(w, n + 1, self.color_type) +
+			chunk(b'IDAT', zlib.compress(data, 0)) +
+			chunk(b'IEND', b''))
+		image = Image.open(io.BytesIO(png))
+		image.load()
+		image = image.crop((0, 1, w, n + 1))
+		prior = b'\x00' + np.asarray(image)[-1].tobytes()
+		return image, prior
+
+	def reduced(self, factor):
+		# the page scaled down by factor, reduced a band at a time
+		# bands must start on multiples of factor to match reducing the whole page
+		if self.band % factor:
+			raise ValueError(f'bands of {self.band} rows cannot be reduced by {factor}')
+		w, h = self.size
+		out = None
+		for top, band in self.bands():
+			if band.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+				band = band.convert('RGB')
+			band = band.reduce(factor)
+			if out is None:
+				out = Image.new(band.mode, (-(-w // factor), -(-h // factor)))
+			out.paste(band, (0, top // factor))
+		return out
+
+	def rows(self, top, bottom):
+		# rows top to bottom of the page as one image
+		# calls must not move top upward, since bands above it are let go
+		top = max(top, 0)
+		bottom = min(bottom, self.height)
+		if self.source is None:
+			self.source = self.bands()
+		self.cache = [(t, b) for t, b in self.cache if t + b.height > top]
+		while not self.cache or self.cache[-1][0] + self.cache[-1][1].height < bottom:
+			band = next(self.source, None)
+			if band is None:
+				break
+			if band[0] + band[1].height > top:
+				self.cache.append(band)
+		out = Image.new(self.mode, (self.width, max(bottom - top, 0)))
+		for t, b in self.cache:
+			if t < bottom and t + b.height > top:
+				out.paste(b, (0, t - top))
+		return out
+
+
+class ScanWriter:
+	# writes a .png a band of rows at a time
+	# rows are stored with the Up filter, which suits scans of line drawings
+	def __init__(self, filepath, size, mode, level=6):
+		color_type = {m: c for c, (m, _) in COLOR_TYPES.items()}[mode]
+		self.f = open(filepath, 'wb')
+		self.f.write(PNG_SIGNATURE + ihdr(size[0], size[1], color_type))
+		self.compress = zlib.compressobj(level)
+		self.prior = None
+
+	def write(self, band):
+		rows = np.asarray(band).reshape(band.height, -1)
+		if self.prior is None:
+			self.prior = np.zeros_like(rows[0])
+		prior = np.concatenate([self.prior[None], rows[:-1]])
+		filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+		filtered[:, 0] = 2 # Up
+		filtered[:, 1:] = rows - prior # wraps around, modulo 256
+		self.prior = rows[-1].copy()
+		data = self.compress.compress(filtered.tobytes())
+		if data:
+			self.f.write(chunk(b'IDAT', data))
+
+	def close(self):
+		self.f.write(chunk(b'IDAT', self.compress.flush()))
+		self.f.write(chunk(b'IEND', b''))
+		self.f.close()
@@ -1,39 +1,80 @@
 '''
 Input a folder of subfolders.
 Each subfolder has all the tiles for one page.
+The .tar or .npy container of a page, written by spec_tile.py --format, may take the place of its subfolder.
 Tiles are rotated and flipped to multiply tile count by 8.
 '''
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+from background import BackgroundWriter
+from container import ContainerReader, is_container, open_writer, replace
+import functools
 import os
 from PIL import Image
+import re
+from runner import Runner, add_arguments
+
+ROTATEFLIPPED = re.compile(r'_rf[01][0-3]\.[^.]+$')
+
+
+def rotateflip(image):
+	# the 8 rotations and flips of an image, with the postfix of each
+	for f in range(2):
+		for r in range(4):
+			image = image.rotate(90)
+			yield f'rf{f}{r}', image
+		image = image.transpose(method=Image.Transpose.FLIP_LEFT_RIGHT)
+
+
+def remove_source(source, _):
+	os.remove(source)
+
+
+def container_worker(args):
+	# the container is written again with the 8 tiles in place of each
+	dir_in, name, compress_level, threads = args
+	path = f'{dir_in}/{name}'
+	ext = os.path.splitext(name)[1]
+	tmp = f'{path}.tmp'
+	with ContainerReader(path) as reader:
+		writer = open_writer(tmp, ext, compress_level)
+		with BackgroundWriter(threads) as background:
+			for tile in reader.names():
+				stem, suffix = os.path.splitext(tile)
+				for postfix, image in rotateflip(reader.image(tile)):
+					background.put(
+						functools.partial(writer.encode, image),
+						functools.partial(writer.write_encoded, f'{stem}_{postfix}{suffix}'))
+		writer.close()
+	replace(tmp, path)
 
 
 def worker(args):
-	dir_in, page = args
+	dir_in, page, compress_level, threads = args
 	dir_in = f'{dir_in}/{page}'
-	# postfix existing images with _rf00
-	images = os.listdir(dir_in)
-	for image in images:
-		image2 = image.split('.')[0] + '_rf00.' + image.split('.')[-1]
-		os.rename(f'{dir_in}/{image}', f'{dir_in}/{image2}')
-	# rotate and flip
-	for tile in [f'{i:02}' for i in range(len(os.listdir(dir_in)))]:
-		source = f'{dir_in}/{page}_t{tile:02}_rf00.png'
-		image = Image.open(source)
-		for f in range(2):
-			for r in range(4):
-				image = image.rotate(90)
-				target = f'{dir_in}/{page}_t{tile:02}_rf{f}{r}.png'
-				image.save(target)
-			image = image.transpose(method=Image.Transpose.FLIP_LEFT_RIGHT)
-
-
-def main(dir_in):
-	pages = os.listdir(dir_in)
-	args = [(dir_in, page) for page in pages]
-	with ProcessPoolExecutor() as executor:
-		executor.map(worker, args)
+	# the tiles on disk not yet rotated and flipped, whatever their numbers
+	# each is removed once its 8 are written, so a page that failed part way is finished by running again
+	tiles = sorted(t for t in os.listdir(dir_in) if not ROTATEFLIPPED.search(t))
+	# the images are encoded on the background writer's threads
+	with BackgroundWriter(threads) as background:
+		for tile in tiles:
+			stem, suffix = os.path.splitext(tile)
+			source = f'{dir_in}/{tile}'
+			with Image.open(source) as image:
+				image.load()
+			for postfix, im in rotateflip(image):
+				background.put(functools.partial(im.save, f'{dir_in}/{stem}_{postfix}{suffix}', compress_level=compress_level))
+			# written in order, so only after the 8 above
+			background.put(lambda: None, functools.partial(remove_source, source))
+
+
+def main(dir_in, compress_level=6, threads=2, runner=None):
+	# subfolders and containers only, not e.g. the cache.json of spec_tile.py
+	pages = [p for p in os.listdir(dir_in) if os.path.isdir(f'{dir_in}/{p}')]
+	containers = [c for c in os.listdir(dir_in) if is_container(c)]
+	args = [(dir_in, page, compress_level, threads) for page in pages]
+	with runner or Runner() as runner:
+		runner.run(worker, args, label=lambda a: a[1])
+		runner.run(container_worker, [(dir_in, c, compress_level, threads) for c in containers], label=lambda a: a[1])
 	#worker(args[0]) # debug
 
 
@@ -44,8 +85,20 @@ if __name__ == '__main__':
 		type=str,
 		default='tile',
 		help='input folder')
+	parser.add_argument(
+		'--compress_level',
+		type=int,
+		choices=range(10),
+		default=6,
+		help='zlib level of the .png tiles, 0 to 9. lower is faster and larger')
+	parser.add_argument(
+		'--writer_threads',
+		type=int,
+		default=2,
+		help='threads per worker that encode tiles while the next are rotated. 0 encodes each tile in turn')
+	add_arguments(parser)
 	args = parser.parse_args()
-	main(args.dir_in)
+	main(args.dir_in, args.compress_level, args.writer_threads, Runner.from_args(args))
 
 
 
@@ -6,11 +6,19 @@ The grid must be precise enough that a vertical line may be drawn
 to separate any pair of adjacent columns. Likewise for rows.
 False flag checks avoid mistaking tiny specs as drawings.
 Thresholds scale according to resolution and may require fine tuning.
+Scans unchanged since the last run at the same resolution are skipped.
 '''
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+from background import BackgroundWriter
+from cache import Manifest, remove
+from container import open_writer, paths
+import functools
+from ink import InkIntegral, dark_pixels, summary
+import numpy as np
 import os
 from PIL import Image, ImageDraw
+from runner import Runner, add_arguments, image_bytes
+from scan import ScanReader, ScanWriter
 
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 Image.MAX_IMAGE_PIXELS = 277813800
@@ -222,33 +230,168 @@ def crop_box(l, r, t, b, res):
 	return l, r, t, b
 
 
-def worker(args):
-	dir_in, res, dir_out, dir_out_grid, pre_res, file = args
+# array engine
+# the same searches as above, computed from a mask of the dark pixels of the page.
+# a pixel is dark where rgb_avg < 128, i.e. r + g + b < 384.
+# every scan above checks whether any pixel in a column (or row) is dark,
+# so each reduces to a lookup in a projection of the dark mask.
+# the scan is read a band of rows at a time, and the mask is packed 8 pixels to a byte,
+# so the page is never held whole in memory.
+
+class DarkMask:
+	# dark pixels of the page packed 8 to a byte
+	# cropping keeps the packed rows and narrows the box they are read through
+	def __init__(self, bits, width, box=None):
+		self.bits = bits
+		self.width = width
+		self.box = box or (0, 0, width, bits.shape[0])
+		self.shape = (self.box[3] - self.box[1], self.box[2] - self.box[0])
+
+	def crop(self, box):
+		l, t, r, b = box
+		x, y = self.box[:2]
+		return DarkMask(self.bits, self.width, (x + l, y + t, x + r, y + b))
+
+	def any_rows(self, t, b):
+		# whether each column has a dark pixel in rows t to b
+		l, y, r, _ = self.box
+		bits = np.bitwise_or.reduce(self.bits[y + t:y + b], axis=0)
+		return np.unpackbits(bits, count=self.width)[l:r].astype(bool)
+
+	def any_cols(self, l, r, chunk=1024):
+		# whether each row has a dark pixel in columns l to r
+		x, y, _, b = self.box
+		x0 = x + l
+		x1 = x + r
+		byte0 = x0 // 8
+		out = np.zeros(b - y, dtype=bool)
+		for t in range(y, b, chunk):
+			bits = np.unpackbits(self.bits[t:min(t + chunk, b), byte0:(x1 + 7) // 8], axis=1)
+			out[t - y:t - y + len(bits)] = bits[:, x0 - byte0 * 8:x1 - byte0 * 8].any(axis=1)
+		return out
+
+
+def dark_mask(reader, ink=None):
+	# ink, if given, counts the dark pixels on the way
+	bits = []
+	for top, band in reader.bands():
+		dark = dark_pixels(band)
+		if ink:
+			ink.add(top, dark)
+		bits.append(np.packbits(dark, axis=1))
+	return DarkMask(np.concatenate(bits), reader.width)
+
+
+def keep_tiles(ink, boxes, offset, min_ink):
+	# numbered boxes whose ink coverage reaches min_ink, before any is cut
+	# offset is where the boxes' page starts on the scan
+	x, y = offset
+	coverage = [float(ink.coverage(l + x, t + y, r + x, b + y)) for l, t, r, b in boxes]
+	keep = [c >= min_ink for c in coverage]
+	return [(n, box) for n, box in enumerate(boxes) if keep[n]], summary(coverage, keep)
+
+
+def shift(proj, t):
+	# shift(proj, t)[i] == proj[i + t], False where i + t falls outside (0, len)
+	out = np.zeros_like(proj)
+	n = len(proj)
+	if t >= 0:
+		if t < n:
+			out[:n - t] = proj[t:]
+	else:
+		if -t < n:
+			out[1 - t:] = proj[1:n + t]
+	return out
+
+
+def next_true(mask, start):
+	# first index >= start where mask is set, else None
+	idx = np.flatnonzero(mask[max(start, 0):])
+	if len(idx) == 0:
+		return None
+	return max(start, 0) + int(idx[0])
+
+
+def last_true(mask, stop):
+	# last index < stop where mask is set, else None
+	idx = np.flatnonzero(mask[:max(stop, 0)])
+	if len(idx) == 0:
+		return None
+	return int(idx[-1])
+
+
+def crop_page_np(dark, margin=40):
+	h, w = dark.shape
+	row = dark.any_rows(h // 2, h // 2 + 1)
+	col = dark.any_cols(w // 2, w // 2 + 1)
+	left = next_true(~row, 0)
+	right = last_true(~row, w)
+	top = next_true(~col, 0)
+	bottom = last_true(~col, h)
+	bounding_box = (
+		left + margin,
+		top + margin,
+		right - margin,
+		bottom - margin
+	)
+	return bounding_box
+
+
+def get_sections(proj, start, s):
+	# get_columns and get_rows along one axis
+	n = len(proj)
+	edge = proj.copy()
+	for t in [2 * s, 5 * s, 10 * s, 15 * s]:
+		edge &= shift(proj, t)
+	sections = []
+	x = start
+	while x < n:
+		found = next_true(edge, x)
+		if found is None:
+			sections.append(n - 1)
+			break
+		sections.append(found)
+		# cross black section
+		white = next_true(~proj, found + 1 + 10 * s)
+		if white is None:
+			break
+		x = white + 1
+	return sections
+
+
+def get_columns_np(dark, s):
+	columns = get_sections(dark.any_rows(0, dark.shape[0]), 100 * s, s)
+	print('columns:', columns)
+	return columns
 
-	pageno = file.split('.')[0]
-	dir_out_tile = f'{dir_out}/p{pageno}'
-	os.makedirs(dir_out_tile, exist_ok=True)
-	print(file)
 
-	img = Image.open(f'{dir_in}/{file}')
-	img = crop_page(img)
-	w, h = img.size
+def get_rows_np(dark, s):
+	rows = get_sections(dark.any_cols(0, dark.shape[1]), 100 * s, s)
+	print('rows:', rows)
+	return rows
 
-	s = res // 256
-	columns = get_columns(img, w, h, s)
-	rows = get_rows(img, w, h, s)
 
-	# draw grid
-	copy = img.copy()
-	draw = ImageDraw.Draw(copy)
-	for x in columns:
-		draw.line([(x, 0), (x, h)], fill='#ff0000', width=5)
-	for y in rows:
-		draw.line([(0, y), (w, y)], fill='#ff0000', width=5)
-	copy.save(f'{dir_out_grid}/{file}')
+def fit_np(dark, l1, r1, t1, b1, thresh=10):
+	h, w = dark.shape
+	# ink in the cell's band of rows, by column
+	proj = dark.any_rows(t1, b1)
+	l2 = next_true(proj & shift(proj, thresh), l1 + 1)
+	r2 = last_true(proj & shift(proj, -thresh), r1)
+	# ink in the cell's band of columns, by row
+	proj = dark.any_cols(l1, r1)
+	t2 = next_true(proj & shift(proj, thresh), t1 + 1)
+	b2 = last_true(proj & shift(proj, -thresh), b1)
+	# nothing found means the cell is blank
+	l2 = w if l2 is None else l2
+	r2 = -1 if r2 is None else r2
+	t2 = h if t2 is None else t2
+	b2 = -1 if b2 is None else b2
+	return l2, r2, t2, b2
+
 
-	# identify and crop
-	tileno = 0
+def find_tiles(columns, rows, fit_cell, pre_res):
+	# crop boxes of the specimens, in the order they are numbered
+	boxes = []
 	for col in range(len(columns) - 1):
 		l1 = columns[col]
 		r1 = columns[col + 1]
@@ -256,28 +399,205 @@ def worker(args):
 			t1 = rows[row]
 			b1 = rows[row + 1]
 			# fit box to exact with and height
-			l2, r2, t2, b2 = fit(img, l1, r1, t1, b1)
+			l2, r2, t2, b2 = fit_cell(l1, r1, t1, b1)
 			# skip blank spaces
 			if l2 > r2 and t2 > b2:
 				continue
 			# find center and standard size box
 			l3, r3, t3, b3 = crop_box(l2, r2, t2, b2, pre_res)
-			crop = img.crop((l3, t3, r3, b3))
-			crop = crop.resize((res, res))
-			filename = f'p{pageno}_t{tileno:02}.png'
-			crop.save(f'{dir_out_tile}/{filename}')
-			tileno += 1
+			boxes.append((l3, t3, r3, b3))
+	return boxes
+
+
+def draw_grid(img, columns, rows, size, top=0, scale=1):
+	# grid lines over the rows of a page of size (w, h) starting at top
+	# img may be the page scaled down by scale
+	w, h = size
+	width = max(1, round(5 / scale))
+	draw = ImageDraw.Draw(img)
+	for x in columns:
+		draw.line([(x / scale, -top / scale), (x / scale, (h - top) / scale)], fill='#ff0000', width=width)
+	for y in rows:
+		draw.line([(0, (y - top) / scale), (w / scale, (y - top) / scale)], fill='#ff0000', width=width)
+
+
+def crop_scan(reader, bounding_box, box):
+	# the same as cropping the page to bounding_box and then to box, read from the scan
+	L, T, R, B = bounding_box
+	l, t, r, b = (int(round(v)) for v in box)
+	crop = Image.new(reader.mode, (r - l, b - t))
+	top = max(T + t, T)
+	bottom = min(T + b, B)
+	left = max(L + l, L)
+	right = min(L + r, R)
+	if top < bottom and left < right:
+		band = reader.rows(top, bottom).crop((left, 0, right, bottom - top))
+		crop.paste(band, (left - L - l, top - T - t))
+	return crop
+
+
+def tile_dirs(dir_out, resolutions, pageno):
+	# output folder of a page's tiles at each resolution
+	# with several resolutions each gets a subfolder of dir_out
+	if len(resolutions) == 1:
+		return {resolutions[0]: f'{dir_out}/p{pageno}'}
+	return {r: f'{dir_out}/{r}/p{pageno}' for r in resolutions}
+
+
+def tile_outputs(dir_out, resolutions, pageno, fmt):
+	# the folder of a page's tiles at each resolution, or the .tar or .npy container in its place
+	dirs = tile_dirs(dir_out, resolutions, pageno)
+	if fmt == 'png':
+		return list(dirs.values())
+	return [p for d in dirs.values() for p in paths(f'{d}.{fmt}')]
+
+
+def save_tile(crop, res, dirs, pageno, tileno, background, compress_level):
+	# cut once at the largest resolution, and reduced to the others
+	# dirs holds a folder or an open container for each resolution
+	# the tiles are encoded on the background writer's threads
+	crop = crop.resize((res, res))
+	filename = f'p{pageno}_t{tileno:02}.png'
+	for r, d in dirs.items():
+		out = crop if r == res else crop.reduce(res // r)
+		if isinstance(d, str):
+			background.put(functools.partial(out.save, f'{d}/{filename}', compress_level=compress_level))
+		else:
+			# named as the .png file would be
+			background.put(
+				functools.partial(d.encode, out),
+				functools.partial(d.write_encoded, f'p{pageno}/{filename}'))
+
+
+def close_writers(dirs):
+	for d in dirs.values():
+		if not isinstance(d, str):
+			d.close()
 
 
-def main(dir_in, res, dir_out, dir_out_grid):
+def worker(args):
+	dir_in, resolutions, dir_out, dir_out_grid, pre_res, engine, scale, min_ink, fmt, compress_level, threads, file = args
 
+	pageno = file.split('.')[0]
+	dirs = tile_dirs(dir_out, resolutions, pageno)
+	# the containers are closed, and tiles still queued are dropped, even if the page fails
+	try:
+		if fmt == 'png':
+			for d in dirs.values():
+				os.makedirs(d, exist_ok=True)
+		else:
+			# the page's tiles go to one container per resolution
+			for r, d in dirs.items():
+				os.makedirs(os.path.dirname(d), exist_ok=True)
+				dirs[r] = open_writer(f'{d}.{fmt}', compress_level=compress_level)
+		with BackgroundWriter(threads) as background:
+			cut_page(args, dirs, background)
+	finally:
+		close_writers(dirs)
+
+
+def cut_page(args, dirs, background):
+	dir_in, resolutions, dir_out, dir_out_grid, pre_res, engine, scale, min_ink, fmt, compress_level, threads, file = args
+	pageno = file.split('.')[0]
+	print(file)
+
+	# the grid is found at the largest resolution
+	res = max(resolutions)
+	s = res // 256
+	if engine == 'pixel':
+		img = Image.open(f'{dir_in}/{file}')
+		img = crop_page(img)
+		w, h = img.size
+		columns = get_columns(img, w, h, s)
+		rows = get_rows(img, w, h, s)
+
+		# draw grid
+		copy = img.copy() if scale == 1 else img.reduce(scale)
+		draw_grid(copy, columns, rows, (w, h), 0, scale)
+		copy.save(f'{dir_out_grid}/{file}')
+
+		# identify and crop
+		fit_cell = lambda l1, r1, t1, b1: fit(img, l1, r1, t1, b1)
+		ink = InkIntegral(img.size)
+		ink.add(0, dark_pixels(img))
+		tiles, stats = keep_tiles(ink, find_tiles(columns, rows, fit_cell, pre_res), (0, 0), min_ink)
+		print(f'{file}: {stats}')
+		for tileno, box in tiles:
+			crop = img.crop(box)
+			save_tile(crop, res, dirs, pageno, tileno, background, compress_level)
+		return
+
+	# first pass over the scan finds the grid and specimens
+	reader = ScanReader(f'{dir_in}/{file}')
+	ink = InkIntegral(reader.size)
+	dark = dark_mask(reader, ink)
+	bounding_box = crop_page_np(dark)
+	dark = dark.crop(bounding_box)
+	h, w = dark.shape
+	columns = get_columns_np(dark, s)
+	rows = get_rows_np(dark, s)
+	fit_cell = lambda l1, r1, t1, b1: fit_np(dark, l1, r1, t1, b1)
+	boxes = find_tiles(columns, rows, fit_cell, pre_res)
+	del dark
+	tiles, stats = keep_tiles(ink, boxes, bounding_box[:2], min_ink)
+	print(f'{file}: {stats}')
+
+	# second pass cuts the tiles and draws the grid, top to bottom
+	# the reader only moves down the page, so a tile is cut before the grid passes its top
+	# a grid preview is reduced a band at a time, so bands start on multiples of scale
+	reader = ScanReader(f'{dir_in}/{file}')
+	grid = ScanWriter(f'{dir_out_grid}/{file}', (-(-w // scale), -(-h // scale)), reader.mode)
+	tiles = sorted(tiles, key=lambda tile: round(tile[1][1]))
+	for top in list(range(0, h, reader.band)) + [None]:
+		while tiles and (top is None or round(tiles[0][1][1]) <= top):
+			tileno, box = tiles.pop(0)
+			crop = crop_scan(reader, bounding_box, box)
+			save_tile(crop, res, dirs, pageno, tileno, background, compress_level)
+		if top is not None:
+			band = crop_scan(reader, bounding_box, (0, top, w, min(top + reader.band, h)))
+			if scale > 1:
+				band = band.reduce(scale)
+			draw_grid(band, columns, rows, (w, h), top, scale)
+			grid.write(band)
+	grid.close()
+
+
+def main(dir_in, resolutions, dir_out, dir_out_grid, engine, force=False, scale=1, min_ink=0, fmt='png', compress_level=6, threads=2, runner=None):
+
+	resolutions = sorted(set(resolutions))
+	res = max(resolutions)
 	pre_res = res + res // 2
+	os.makedirs(dir_out, exist_ok=True)
 	os.makedirs(dir_out_grid, exist_ok=True)
 	files = os.listdir(dir_in)
-
-	args = [(dir_in, res, dir_out, dir_out_grid, pre_res, f) for f in files]
-	with ProcessPoolExecutor() as executor:
-		executor.map(worker, args)
+	manifest = Manifest(f'{dir_out}/cache.json', force)
+
+	# both engines cut the same tiles, so the engine is not part of the key
+	args = []
+	keys = {}
+	# a single resolution keys as before, so earlier runs stay valid
+	resolution = res if len(resolutions) == 1 else resolutions
+	for f in files:
+		params = {'resolution': resolution, 'scale': scale, 'min_ink': min_ink}
+		if fmt != 'png':
+			params['format'] = fmt
+		key = manifest.key(f'{dir_in}/{f}', params)
+		outputs = tile_outputs(dir_out, resolutions, f.split('.')[0], fmt) + [f'{dir_out_grid}/{f}']
+		if manifest.fresh(f, key, outputs):
+			continue
+		remove(outputs)
+		keys[f] = key
+		args.append((dir_in, resolutions, dir_out, dir_out_grid, pre_res, engine, scale, min_ink, fmt, compress_level, threads, f))
+	# the pixel engine holds the page decoded, the array engine a band of it and its dark pixels
+	if engine == 'pixel':
+		cost = lambda a: image_bytes(f'{dir_in}/{a[-1]}')
+	else:
+		cost = lambda a: image_bytes(f'{dir_in}/{a[-1]}') // 8
+	with runner or Runner() as runner:
+		for a, _, error in runner.completed(worker, args, cost, lambda a: a[-1]):
+			# a page that fails is reported and left for the next run
+			if not error:
+				manifest.done(a[-1], keys[a[-1]])
 	#worker(args[0]) # debug
 
 
@@ -290,8 +610,11 @@ if __name__ == '__main__':
 	parser.add_argument(
 		'resolution',
 		type=int,
+		nargs='+',
 		choices=[256, 512, 1024],
-		help='resolution of square tiles. 256px <=> dpi300')
+		help='resolution of square tiles. 256px <=> dpi300. ' +
+		'with several, the largest must match the scans, and the tiles are reduced from it to the others, ' +
+		'each in a subfolder of dir_out')
 	parser.add_argument(
 		'--dir_out',
 		type=str,
@@ -302,8 +625,51 @@ if __name__ == '__main__':
 		type=str,
 		default='grid',
 		help='output folder for grid')
+	parser.add_argument(
+		'--engine',
+		type=str,
+		choices=['array', 'pixel'],
+		default='array',
+		help='array: detect from dark pixel projections of the decoded page. ' +
+		'pixel: original pixel by pixel search')
+	parser.add_argument(
+		'--force',
+		action='store_true',
+		help='work every scan, even those unchanged since the last run')
+	parser.add_argument(
+		'--preview',
+		type=int,
+		choices=[2, 4, 8, 16, 32],
+		default=1,
+		help='scale the grid overlays down by this factor')
+	parser.add_argument(
+		'--min_ink',
+		type=float,
+		default=0,
+		help='skip specimens whose tile has less than this fraction of dark pixels, e.g. 0.01')
+	parser.add_argument(
+		'--format',
+		type=str,
+		choices=['png', 'tar', 'npy'],
+		default='png',
+		help='png: one file per tile in a subfolder per page. ' +
+		'tar: a .tar of the .png files per page. npy: a uint8 .npy stack of the tiles per page, with an index')
+	parser.add_argument(
+		'--compress_level',
+		type=int,
+		choices=range(10),
+		default=6,
+		help='zlib level of the .png tiles, 0 to 9. lower is faster and larger')
+	parser.add_argument(
+		'--writer_threads',
+		type=int,
+		default=2,
+		help='threads per worker that encode tiles while the next are cut. 0 encodes each tile as it is cut')
+	add_arguments(parser)
 	args = parser.parse_args()
-	main(args.dir_in, args.resolution, args.dir_out, args.dir_out_grid)
+	main(
+		args.dir_in, args.resolution, args.dir_out, args.dir_out_grid, args.engine, args.force,
+		args.preview, args.min_ink, args.format, args.compress_level, args.writer_threads, Runner.from_args(args))
 
 
 
@@ -0,0 +1,64 @@
+'''
+spec_tile.py --min_ink keeps each tile's specimen number, so the numbers of a page can have gaps.
+spec_rotateflip.py must rotate and flip every tile kept, and finish a page if run again.
+A tile whose rotations fail to save is kept, so the page can be run again.
+Run with pytest from this folder.
+'''
+from bench import spec_page
+import os
+from PIL import Image
+import pytest
+import random
+import spec_rotateflip
+import subprocess
+import sys
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(cwd, name, *args):
+	subprocess.run([sys.executable, f'{SCRIPTS}/{name}.py', *args, '--workers', '1'], cwd=cwd, check=True)
+
+
+def test_min_ink_then_rotateflip(tmp_path):
+	os.makedirs(tmp_path / 'in')
+	spec_page(random.Random(0), 300, 2, 3).save(tmp_path / 'in' / '0.png')
+	run(tmp_path, 'spec_tile', 'in', '256', '--dir_out', 't_ink', '--min_ink', '0.02', '--force')
+	page = tmp_path / 't_ink' / 'p0'
+	tiles = sorted(os.listdir(page))
+	# the first specimen has too little ink on this page, so the numbers start with a gap
+	assert tiles and 'p0_t00.png' not in tiles
+
+	run(tmp_path, 'spec_rotateflip', 't_ink')
+	expected = sorted(f'{t[:-4]}_rf{f}{r}.png' for t in tiles for f in range(2) for r in range(4))
+	assert sorted(os.listdir(page)) == expected
+
+	# a second run finds nothing left to do
+	run(tmp_path, 'spec_rotateflip', 't_ink')
+	assert sorted(os.listdir(page)) == expected
+
+
+def test_failed_save_keeps_source(tmp_path, monkeypatch):
+	page = tmp_path / 'p0'
+	os.makedirs(page)
+	tiles = [f'p0_t{n:02}.png' for n in (0, 3, 5, 6)]
+	for n, t in enumerate(tiles):
+		Image.new('L', (64, 64), 40 * n).save(page / t)
+
+	save = Image.Image.save
+
+	def failing_save(im, fp, *args, **kwargs):
+		if str(fp).endswith('p0_t00_rf02.png'):
+			raise OSError('disk full')
+		return save(im, fp, *args, **kwargs)
+
+	# the error surfaces while the tiles after it are still queued
+	monkeypatch.setattr(Image.Image, 'save', failing_save)
+	with pytest.raises(OSError):
+		spec_rotateflip.worker((str(tmp_path), 'p0', 6, 2))
+	assert 'p0_t00.png' in os.listdir(page)
+
+	monkeypatch.setattr(Image.Image, 'save', save)
+	spec_rotateflip.worker((str(tmp_path), 'p0', 6, 2))
+	expected = sorted(f'{t[:-4]}_rf{f}{r}.png' for t in tiles for f in range(2) for r in range(4))
+	assert sorted(os.listdir(page)) == expected
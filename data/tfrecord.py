@@ -1,79 +1,310 @@
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+from cache import file_digest, remove
+from container import ContainerReader, is_container
+import functools
+import hashlib
+import io
+import json
 import numpy as np
 import os
 from PIL import Image
-import tensorflow as tf
-
-os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+import random
+from runner import Runner, add_arguments
+from scan import COLOR_TYPES, PNG_SIGNATURE
+import struct
+from tfrecord_io import TFRecordWriter, encode_example, frame, index_path, write_index
 
 
 def sample(image_string, image_shape):
-	feature = {
-		'image_bytes': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image_string])),
-		'image_shape': tf.train.Feature(int64_list=tf.train.Int64List(value=image_shape)),
-	}
-	return tf.train.Example(features=tf.train.Features(feature=feature))
+	# serialized tf.train.Example
+	return encode_example(image_string, image_shape)
+
+
+def encode_png(im):
+	# im has shape (height, width, channels)
+	buf = io.BytesIO()
+	Image.fromarray(im[:, :, 0] if im.shape[-1] == 1 else im).save(buf, format='PNG')
+	return buf.getvalue()
+
+
+def png_shape(data):
+	# image_shape read from the IHDR chunk, so the .png can be stored as it is
+	# None if training would not decode it to 8-bit pixels of that shape:
+	# palette, 16-bit or transparency (tRNS) images
+	if data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+		return None
+	w, h, depth, color_type = struct.unpack('>IIBB', data[16:26])
+	if color_type not in COLOR_TYPES or depth > 8:
+		return None
+	i = 8
+	while i + 8 <= len(data):
+		length, chunk_type = struct.unpack('>I4s', data[i:i + 8])
+		if chunk_type == b'tRNS':
+			return None
+		if chunk_type == b'IDAT':
+			break
+		i += length + 12 # length, type, data, crc
+	return (h, w, COLOR_TYPES[color_type][1])
+
+
+def reencode(data):
+	# decode and encode again as an 8-bit .png
+	im = Image.open(io.BytesIO(data))
+	mode = im.mode
+	if 'transparency' in im.info:
+		im = im.convert('RGBA')
+	elif mode == 'P':
+		im = im.convert('RGB')
+	im = np.array(im)
+	# 16-bit samples keep their high byte
+	if im.dtype not in (np.uint8, bool):
+		im = im >> 8
+	# for pixels with 3-4 channels (RGB or RGBA) the array has shape (3-4, X)
+	# for pixels with 1 channel (L or 1) the array has shape (X) and must be expanded to (1, X)
+	if im.ndim == 2:
+		im = np.expand_dims(im, axis=-1)
+	im = im.astype(np.uint8)
+	return encode_png(im), im.shape
+
+
+def pixel_digest(im_string):
+	# hash of the decoded pixels, whatever the .png encoding
+	# manifests written before 'digest' list these
+	pixels = np.asarray(Image.open(io.BytesIO(im_string)))
+	h = hashlib.blake2b(digest_size=16)
+	h.update(str(pixels.shape).encode())
+	h.update(pixels.tobytes())
+	return h.hexdigest()
+
+
+def record_digest(im_string, im_shape):
+	# hash of the image as the record stores it, its shape and encoded bytes
+	# nothing is decoded, so a .png that passes through costs only the hash
+	h = hashlib.blake2b(digest_size=16)
+	h.update(','.join(map(str, im_shape)).encode())
+	h.update(im_string)
+	return h.hexdigest()
+
+
+def digest(kind, im_string, im_shape):
+	# the digest of a record listed in a manifest, as its 'digest' says
+	if kind == 'pixels':
+		return pixel_digest(im_string)
+	return record_digest(im_string, im_shape)
+
+
+class ShardWriter:
+	# writes records to {prefix}_{k}.tfrecord in dir_out, or {k}.tfrecord without a prefix
+	# a new shard is started when the next record would take the shard past size bytes
+	# each shard gets an index of its records, {prefix}_{k}.tfrecord.index
+	def __init__(self, dir_out, prefix, size, first=0):
+		self.dir_out = dir_out
+		self.prefix = prefix
+		self.size = size
+		self.shard_i = first
+		self.written = 0
+		self.writer = None
+		self.shard_path = None
+		self.index = None
+
+	def write(self, im_string, im_shape):
+		return self.write_framed(frame(sample(im_string, im_shape)), im_shape)
+
+	def write_framed(self, framed, im_shape):
+		# framed is the record with its length and two checksums, as it is laid out in the shard
+		# returns the shard's file name and the record's number in it
+		if self.writer and self.written + len(framed) > self.size:
+			self.close()
+		if not self.writer:
+			name = f'{self.prefix}_{self.shard_i}' if self.prefix else f'{self.shard_i}'
+			self.shard_path = os.path.join(self.dir_out, f'{name}.tfrecord')
+			self.writer = TFRecordWriter(self.shard_path)
+			self.index = ([], [], [])
+			self.shard_i += 1
+			self.written = 0
+		self.writer.write_framed(framed)
+		offsets, lengths, shapes = self.index
+		offsets.append(self.written)
+		lengths.append(len(framed) - 16)
+		shapes.append(im_shape)
+		self.written += len(framed)
+		return os.path.basename(self.shard_path), len(offsets) - 1
+
+	def close(self):
+		if self.writer:
+			self.writer.close()
+			write_index(self.shard_path, *self.index)
+			self.writer = None
+
+
+@functools.lru_cache(maxsize=8)
+def container(path, mtime):
+	# each worker finds the tiles of a container once, while it is unchanged
+	return ContainerReader(path)
+
+
+def source_path(dir_in, source):
+	# a source is {subdir}/{filename} for a .png file, or {container}:{name} for a tile in a .tar or .npy
+	return f'{dir_in}/{source.split(":")[0]}'
+
+
+def read_source(dir_in, source):
+	# the .png bytes of a tile, or its pixels if it is in a .npy stack
+	path = source_path(dir_in, source)
+	if ':' in source:
+		return container(path, os.stat(path).st_mtime_ns).read(source.split(':', 1)[1])
+	with open(path, 'rb') as f:
+		return f.read()
+
+
+def source_digest(data):
+	if isinstance(data, np.ndarray):
+		data = data.tobytes()
+	return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
 def worker(args):
-	dir_in, group_i, group, dir_out = args
-
-	writer = None
-
-	for im_path in group:
-		with open(im_path, 'rb') as f:
-			im = Image.open(f)
-			mode = im.mode
-			im = np.array(im)
-			# for pixels with 3-4 channels (RGB or RGBA) the array has shape (3-4, X)
-			# for pixels with 1 channel (L or 1) the array has shape (X) and must be expanded to (1, X)
-			if mode == 'L' or mode == '1':
-				im = np.expand_dims(im, axis=-1)
-			im_shape = im.shape
-			im_tensor = tf.convert_to_tensor(im, dtype=tf.uint8)
-			im_string = tf.io.encode_png(im_tensor).numpy()
-
-		im_size = len(im_string)
-
-		if not writer:
-			shard_path = os.path.join(dir_out, f'{group_i}.tfrecord')
-			writer = tf.io.TFRecordWriter(shard_path)
-
-		tf_example = sample(im_string, im_shape)
-		writer.write(tf_example.SerializeToString())
-
-	if writer:
-		writer.close()
-
-
-def gs_estimate(filepaths, T):
-	# adjust group size so .tfrecord files are between 100 and 500 MB
-	# target size of .tfrecord file is 300 MB
-	# adjust for very small datasets so there is more than one file
-	C = min(len(filepaths), 1000) # number of .png files to average
-	P = 0 # total size of .png files
-	for fp in filepaths[:1000]:
-		P += os.path.getsize(fp)
-	# T = G * P / C <=> .tfrecord size = group size * average .png size
-	G = T * C / P # group size
-	return int(G)
-
-
-def main(dir_in, dir_out, T):
+	# (framed record, image shape, manifest entry) for a chunk of tiles, in order
+	dir_in, group, passthrough, kind = args
+
+	records = []
+
+	for source in group:
+		data = read_source(dir_in, source)
+		st = os.stat(source_path(dir_in, source))
+		if isinstance(data, np.ndarray):
+			# pixels are encoded as they will be decoded in training
+			im_string, im_shape = encode_png(data), data.shape
+		else:
+			# the .png is stored as it is, unless its pixels must be converted
+			im_shape = png_shape(data) if passthrough else None
+			if im_shape:
+				im_string = data
+			else:
+				im_string, im_shape = reencode(data)
+
+		records.append((
+			frame(sample(im_string, im_shape)),
+			im_shape,
+			tile_entry(source, digest(kind, im_string, im_shape), source_digest(data), st)))
+
+	return records
+
+
+def tile_entry(source, digest, data_digest, st):
+	# how the manifest lists each record:
+	# source within dir_in, digest of the stored record, digest of the source tile,
+	# and the size and modification time of the file holding it
+	return [source, digest, data_digest, st.st_size, st.st_mtime_ns]
+
+
+def changed(dir_in, tile):
+	# the source of a record was removed, or its content is no longer what was stored
+	source, _, data_digest, size, mtime = tile
+	im_path = source_path(dir_in, source)
+	if not os.path.exists(im_path):
+		return True
+	st = os.stat(im_path)
+	if [st.st_size, st.st_mtime_ns] == [size, mtime]:
+		return False
+	if ':' in source:
+		# the container was written again, so compare the tile itself
+		try:
+			return source_digest(read_source(dir_in, source)) != data_digest
+		except KeyError:
+			return True
+	return file_digest(im_path) != data_digest
+
+
+def shard_paths(dir_out, name):
+	return [f'{dir_out}/{name}', index_path(f'{dir_out}/{name}')]
+
+
+def write_shards(dir_in, dir_out, sources, T, passthrough, first, chunk, runner, kind='record'):
+	# records are encoded in chunks by the workers and written in order,
+	# so a shard is closed on its actual size and the same order writes the same bytes
+	args = [(dir_in, sources[i:i + chunk], passthrough, kind) for i in range(0, len(sources), chunk)]
+	writer = ShardWriter(dir_out, None, T, first)
+	shards = {}
+
+	def write(records):
+		for record, im_shape, tile in records:
+			name, _ = writer.write_framed(record, im_shape)
+			shard = shards.setdefault(name, {'count': 0, 'tiles': []})
+			shard['count'] += 1
+			shard['tiles'].append(tile)
+
+	with runner:
+		for records in runner.map(worker, args, label=lambda a: a[1][0]):
+			write(records)
+	#worker(args[0]) # debug
+	writer.close()
+	return shards
+
+
+def main(dir_in, dir_out, T, passthrough=True, seed=None, append=False, prune=False, chunk=64, runner=None):
 	os.makedirs(dir_out, exist_ok=True)
-	filepaths = []
+	sources = []
 	# dir_in must follow folder tree structure created by tile.py
-	# i.e. 1 layer of subfolders
-	for subdir in os.listdir(dir_in):
-		for filename in os.listdir(f'{dir_in}/{subdir}'):
-			filepaths.append(f'{dir_in}/{subdir}/{filename}')
-	group_size = gs_estimate(filepaths, T)
-	groups = [filepaths[i:i + group_size] for i in range(0, len(filepaths), group_size)]
-	args = [(dir_in, x_i, x, dir_out) for x_i, x in enumerate(groups)]
-	with ProcessPoolExecutor() as executor:
-		executor.map(worker, args)
-	#worker(args[0]) # debug
+	# i.e. 1 layer of subfolders, or the .tar and .npy containers written in their place
+	# other files, e.g. the cache.json of the tile scripts, are not tiles
+	for entry in sorted(os.listdir(dir_in)):
+		if os.path.isdir(f'{dir_in}/{entry}'):
+			for filename in sorted(os.listdir(f'{dir_in}/{entry}')):
+				sources.append(f'{entry}/{filename}')
+		elif is_container(entry):
+			with ContainerReader(f'{dir_in}/{entry}') as reader:
+				sources.extend(f'{entry}:{name}' for name in reader.names())
+
+	# manifest.json lists the shards and the records in each,
+	# for tfrecord_reverse.py --verify and for appending to the dataset
+	manifest_path = f'{dir_out}/manifest.json'
+	manifest = {'seeds': [], 'shards': {}}
+	if os.path.exists(manifest_path):
+		with open(manifest_path, 'r') as f:
+			manifest = json.load(f)
+
+	shards = {}
+	if append:
+		# keep the shards already written, unless pruning those with removed or changed sources
+		stale = 0
+		for name, shard in manifest['shards'].items():
+			n = sum(changed(dir_in, tile) for tile in shard['tiles'])
+			if n and prune:
+				remove(shard_paths(dir_out, name))
+				print('dropped:', name)
+			else:
+				shards[name] = shard
+				stale += n
+		if stale:
+			print(f'{stale} records have sources that were removed or changed. --prune drops their shards')
+		seeds = manifest['seeds']
+		# new records are listed as the ones kept are
+		kind = manifest.get('digest', 'pixels') if shards else 'record'
+	else:
+		for name in manifest['shards']:
+			remove(shard_paths(dir_out, name))
+		seeds = []
+		kind = 'record'
+
+	# only tiles that are in no shard are written, to new shards after the last
+	written = set(tile[0] for shard in shards.values() for tile in shard['tiles'])
+	sources = [s for s in sources if s not in written]
+	first = max((int(name.split('.')[0]) + 1 for name in shards), default=0)
+
+	# shuffle across the whole dataset, so every shard mixes tiles from every page
+	# and a small shuffle buffer in training is enough
+	if seed is None:
+		seed = random.randrange(2**32)
+	print('seed:', seed)
+	print('tiles:', len(sources))
+	random.Random(seed).shuffle(sources)
+	shards.update(write_shards(dir_in, dir_out, sources, T, passthrough, first, chunk, runner or Runner(), kind))
+
+	tmp = f'{manifest_path}.tmp'
+	with open(tmp, 'w') as f:
+		json.dump({'seeds': seeds + [seed] if sources else seeds, 'digest': kind, 'shards': shards}, f)
+	os.replace(tmp, manifest_path)
 
 
 if __name__ == '__main__':
@@ -81,7 +312,7 @@ if __name__ == '__main__':
 	parser.add_argument(
 		'dir_in',
 		type=str,
-		help='folder of source images e.g. tile')
+		help='folder of source images e.g. tile, in subfolders or .tar and .npy containers')
 	parser.add_argument(
 		'--dir_out',
 		type=str,
@@ -91,9 +322,28 @@ if __name__ == '__main__':
 		'--size',
 		type=int,
 		default=300000000,
-		help='output .tfrecord size in bytes')
+		help='maximum .tfrecord size in bytes')
+	parser.add_argument(
+		'--seed',
+		type=int,
+		default=None,
+		help='seed for the order of the images across the .tfrecord files. the same seed writes the same files')
+	parser.add_argument(
+		'--append',
+		action='store_true',
+		help='keep the .tfrecord files in dir_out and write only tiles not yet in them, to new files')
+	parser.add_argument(
+		'--prune',
+		action='store_true',
+		help='with --append, drop files holding tiles whose source was removed or changed, and write their other tiles again')
+	parser.add_argument(
+		'--reencode',
+		action='store_true',
+		help='decode and encode every .png again. ' +
+		'by default .png files are stored as they are, and only palette, 16-bit or transparent ones are converted')
+	add_arguments(parser)
 	args = parser.parse_args()
-	main(args.dir_in, args.dir_out, args.size)
+	main(args.dir_in, args.dir_out, args.size, not args.reencode, args.seed, args.append, args.prune, runner=Runner.from_args(args))
 
 
 
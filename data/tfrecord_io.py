@@ -0,0 +1,357 @@
+'''
+Reads and writes .tfrecord files without tensorflow.
+Records hold a tf.train.Example with the two features train.py reads:
+image_bytes (the encoded image) and image_shape (height, width, channels).
+Each record in the file is framed as
+- length: uint64, little endian
+- masked crc32c of length: uint32
+- data
+- masked crc32c of data: uint32
+Next to each file an index, {file}.index, may list where each record is.
+It is json with the record count, and the byte offset, data length and image shape of each record,
+and the size and modification time of the file it was written for.
+An index that no longer matches its file, e.g. one left behind when the file was rewritten, is built again.
+'''
+import json
+import numpy as np
+import os
+import struct
+
+CRC32C_POLY = 0x82F63B78 # Castagnoli, reflected
+BLOCK = 64 # bytes per block when checksumming blocks in parallel
+
+
+def make_table():
+	table = []
+	for i in range(256):
+		c = i
+		for _ in range(8):
+			c = (c >> 1) ^ (CRC32C_POLY if c & 1 else 0)
+		table.append(c)
+	return table
+
+
+TABLE = make_table()
+TABLE_NP = np.array(TABLE, dtype=np.uint32)
+
+
+def crc_update(crc, data):
+	# one byte at a time, for short data
+	for b in data:
+		crc = TABLE[(crc ^ b) & 0xFF] ^ (crc >> 8)
+	return crc
+
+
+def apply(tables, crc):
+	# a linear map of crc registers, as one lookup table per byte
+	return (
+		tables[0][crc & 0xFF] ^
+		tables[1][(crc >> 8) & 0xFF] ^
+		tables[2][(crc >> 16) & 0xFF] ^
+		tables[3][crc >> 24])
+
+
+def zero_tables():
+	# maps of the crc register across BLOCK * 2**j zero bytes, for j = 0, 1, ...
+	# crc over zeros is linear in the register, so a table per byte of the register is enough
+	v = np.arange(256, dtype=np.uint32)
+	tables = [v << np.uint32(8 * k) for k in range(4)]
+	for _ in range(BLOCK):
+		tables = [TABLE_NP[t & 0xFF] ^ (t >> np.uint32(8)) for t in tables]
+	powers = [tables]
+	for _ in range(40):
+		t = powers[-1]
+		powers.append([apply(t, u) for u in t])
+	return powers
+
+
+ZEROS = zero_tables()
+
+
+def crc32c(data):
+	n = len(data)
+	k = n // BLOCK
+	head = n - k * BLOCK
+	crc = crc_update(0xFFFFFFFF, data[:head])
+	if k:
+		# checksum each block from a zero register, all blocks at once
+		blocks = np.frombuffer(data, dtype=np.uint8, offset=head).reshape(k, BLOCK)
+		raw = np.zeros(k, dtype=np.uint32)
+		for j in range(BLOCK):
+			raw = TABLE_NP[(raw ^ blocks[:, j]) & 0xFF] ^ (raw >> np.uint32(8))
+		# fold neighbouring blocks together until one is left
+		# a zero block put in front changes nothing
+		level = 0
+		while len(raw) > 1:
+			if len(raw) % 2:
+				raw = np.concatenate([np.zeros(1, dtype=np.uint32), raw])
+			raw = apply(ZEROS[level], raw[0::2]) ^ raw[1::2]
+			level += 1
+		# carry the register from before the blocks past them
+		crc = np.uint32(crc)
+		j = 0
+		while k:
+			if k & 1:
+				crc = apply(ZEROS[j], crc)
+			k >>= 1
+			j += 1
+		crc = int(crc ^ raw[0])
+	return crc ^ 0xFFFFFFFF
+
+
+def masked_crc32c(data):
+	crc = crc32c(data)
+	return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+# protocol buffers, just enough for tf.train.Example
+
+def varint(n):
+	n &= 0xFFFFFFFFFFFFFFFF
+	out = bytearray()
+	while n > 0x7F:
+		out.append((n & 0x7F) | 0x80)
+		n >>= 7
+	out.append(n)
+	return bytes(out)
+
+
+def field(number, payload):
+	# length delimited field
+	return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+def encode_example(image_bytes, image_shape):
+	# Example { Features features = 1 }
+	# Features { map<string, Feature> feature = 1 }
+	# Feature { BytesList bytes_list = 1; Int64List int64_list = 3 }
+	# BytesList { repeated bytes value = 1 }
+	# Int64List { repeated int64 value = 1 [packed] }
+	bytes_list = field(1, field(1, image_bytes))
+	int64_list = field(3, field(1, b''.join(varint(int(v)) for v in image_shape)))
+	features = (
+		field(1, field(1, b'image_bytes') + field(2, bytes_list)) +
+		field(1, field(1, b'image_shape') + field(2, int64_list)))
+	return field(1, features)
+
+
+def read_varint(data, i):
+	n = 0
+	shift = 0
+	while True:
+		b = data[i]
+		i += 1
+		n |= (b & 0x7F) << shift
+		if b < 0x80:
+			return n, i
+		shift += 7
+
+
+def read_fields(data):
+	# yield (number, wire type, value) for each field of a message
+	i = 0
+	while i < len(data):
+		key, i = read_varint(data, i)
+		number, wire = key >> 3, key & 7
+		if wire == 0:
+			value, i = read_varint(data, i)
+		elif wire == 1:
+			value = data[i:i + 8]
+			i += 8
+		elif wire == 2:
+			length, i = read_varint(data, i)
+			value = data[i:i + length]
+			i += length
+		elif wire == 5:
+			value = data[i:i + 4]
+			i += 4
+		else:
+			raise ValueError(f'unsupported wire type {wire}')
+		yield number, wire, value
+
+
+def decode_example(record):
+	# dict of feature name to a list of bytes or of ints
+	features = {}
+	for _, _, feats in read_fields(record):
+		for _, _, entry in read_fields(feats):
+			key = None
+			values = []
+			for number, _, value in read_fields(entry):
+				if number == 1:
+					key = bytes(value).decode()
+				elif number == 2:
+					for kind, _, lst in read_fields(value):
+						for _, wire, v in read_fields(lst):
+							if kind == 1:
+								values.append(bytes(v))
+							elif wire == 2: # packed
+								j = 0
+								while j < len(v):
+									n, j = read_varint(v, j)
+									values.append(n - (1 << 64) if n >> 63 else n)
+							elif wire == 0:
+								values.append(v - (1 << 64) if v >> 63 else v)
+			features[key] = values
+	return features
+
+
+def frame(record):
+	# the record as it is laid out in the file
+	length = struct.pack('<Q', len(record))
+	return (
+		length +
+		struct.pack('<I', masked_crc32c(length)) +
+		record +
+		struct.pack('<I', masked_crc32c(record)))
+
+
+class TFRecordWriter:
+	def __init__(self, path):
+		self.f = open(path, 'wb')
+
+	def write(self, record):
+		self.f.write(frame(record))
+
+	def write_framed(self, framed):
+		# a record already framed by frame(), e.g. in another process
+		self.f.write(framed)
+
+	def close(self):
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+def read_records(path, check=True):
+	# yield the data of each record in the file
+	with open(path, 'rb') as f:
+		while True:
+			header = f.read(12)
+			if not header:
+				return
+			if len(header) < 12:
+				raise ValueError(f'{path} is truncated')
+			length, length_crc = struct.unpack('<QI', header)
+			if check and masked_crc32c(header[:8]) != length_crc:
+				raise ValueError(f'{path} has a corrupt record length')
+			record = f.read(length)
+			footer = f.read(4)
+			if len(record) < length or len(footer) < 4:
+				raise ValueError(f'{path} is truncated')
+			if check and masked_crc32c(record) != struct.unpack('<I', footer)[0]:
+				raise ValueError(f'{path} has a corrupt record')
+			yield record
+
+
+def index_path(path):
+	return f'{path}.index'
+
+
+def write_index(path, offsets, lengths, shapes):
+	# once the file is written, so its size and time are final
+	st = os.stat(path)
+	index = {
+		'count': len(offsets),
+		'size': st.st_size,
+		'mtime': st.st_mtime_ns,
+		'offsets': offsets, # of each framed record in the file
+		'lengths': lengths, # of the data of each record
+		'shapes': [list(shape) for shape in shapes]
+	}
+	with open(index_path(path), 'w') as f:
+		json.dump(index, f)
+
+
+def build_index(path):
+	# read the whole file once, for files written without an index
+	offsets = []
+	lengths = []
+	shapes = []
+	offset = 0
+	for record in read_records(path):
+		offsets.append(offset)
+		lengths.append(len(record))
+		shapes.append(decode_example(record)['image_shape'])
+		offset += len(record) + 16
+	write_index(path, offsets, lengths, shapes)
+
+
+def read_index(path):
+	# the index of a file, or None if there is none or it was written for another version of the file
+	# an index from before 'size' and 'mtime' is checked against the end of its last record
+	try:
+		with open(index_path(path)) as f:
+			index = json.load(f)
+	except (OSError, ValueError):
+		return None
+	st = os.stat(path)
+	end = index['offsets'][-1] + index['lengths'][-1] + 16 if index['count'] else 0
+	if end != st.st_size or index.get('size', end) != st.st_size or index.get('mtime', st.st_mtime_ns) != st.st_mtime_ns:
+		return None
+	return index
+
+
+class IndexedReader:
+	# random access to the records of a file through its index
+	def __init__(self, path):
+		self.path = path
+		index = read_index(path)
+		if index is None:
+			build_index(path)
+			index = read_index(path)
+		self.count = index['count']
+		self.offsets = index['offsets']
+		self.lengths = index['lengths']
+		self.shapes = index['shapes']
+		self.f = None
+
+	def __len__(self):
+		return self.count
+
+	def shape(self, n):
+		return self.shapes[n]
+
+	def read(self, n, check=True):
+		# the data of record n
+		if self.f is None:
+			self.f = open(self.path, 'rb')
+		self.f.seek(self.offsets[n] + 12)
+		record = self.f.read(self.lengths[n])
+		footer = self.f.read(4)
+		if len(record) < self.lengths[n] or len(footer) < 4:
+			raise ValueError(f'{self.path} is truncated')
+		if check and masked_crc32c(record) != struct.unpack('<I', footer)[0]:
+			raise ValueError(f'{self.path} has a corrupt record {n}')
+		return record
+
+	def records(self, start=0, stop=None):
+		# yield the data of records start to stop
+		stop = self.count if stop is None else min(stop, self.count)
+		for n in range(start, stop):
+			yield self.read(n)
+
+	def ranges(self, k):
+		# split the records into at most k (start, stop) ranges of about equal bytes,
+		# for parallel readers to take one each
+		if self.count == 0:
+			return []
+		total = self.offsets[-1] + self.lengths[-1] + 16
+		bounds = [0]
+		n = 0
+		for j in range(1, k):
+			while n < self.count and self.offsets[n] < total * j / k:
+				n += 1
+			if n > bounds[-1] and n < self.count:
+				bounds.append(n)
+		bounds.append(self.count)
+		return list(zip(bounds[:-1], bounds[1:]))
+
+	def close(self):
+		if self.f:
+			self.f.close()
+			self.f = None
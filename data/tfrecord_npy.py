@@ -0,0 +1,87 @@
+'''
+Decodes the .tfrecord files once, into a single .npy file that training reads without decoding.
+The .npy is a uint8 stack of shape (count, height, width, channels), in the order of the records,
+with an index of where each came from, {file}.index, as written by container.py.
+Every image must have the same shape. --channels converts them to the same number of channels.
+It takes several times the disk space of the .tfrecord files, e.g. 192KB per 256x256 RGB image.
+Set dataset_file_pattern in options.json to the .npy file to train from it.
+'''
+import argparse
+from container import NpyWriter, paths, replace, tile_array
+import os
+from runner import Runner, add_arguments
+from tfrecord_io import IndexedReader
+from tfrecord_reverse import decode_image, parse_function
+
+MODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}
+
+
+def worker(args):
+	dir_in, filename, start, stop, channels = args
+	reader = IndexedReader(f'{dir_in}/{filename}')
+	arrays = []
+	for j, proto in enumerate(reader.records(start, stop), start):
+		image = decode_image(parse_function(proto))
+		if channels:
+			image = image.convert(MODES[channels])
+		arrays.append((f'{filename}:{j}', tile_array(image)))
+	reader.close()
+	return arrays
+
+
+def main(dir_in, file_out, channels=0, chunk=64, runner=None):
+	runner = runner or Runner()
+	filenames = sorted(f for f in os.listdir(dir_in) if f.endswith('.tfrecord'))
+	# each file is split into chunks of records, decoded in parallel and written in order
+	args = []
+	for f in filenames:
+		reader = IndexedReader(f'{dir_in}/{f}')
+		for start in range(0, len(reader), chunk):
+			args.append((dir_in, f, start, min(start + chunk, len(reader)), channels))
+		reader.close()
+
+	# written to a temporary file, so a failed run leaves no partial .npy to train from
+	tmp = f'{file_out}.tmp.npy'
+	writer = NpyWriter(tmp)
+	try:
+		with runner:
+			for arrays in runner.map(worker, args, label=lambda a: f'{a[1]} {a[2]}:{a[3]}'):
+				for name, a in arrays:
+					writer.write_encoded(name, a)
+		#worker(args[0]) # debug
+		writer.close()
+	except BaseException:
+		writer.f.close()
+		for path in paths(tmp):
+			if os.path.exists(path):
+				os.remove(path)
+		raise
+	replace(tmp, file_out)
+	print(f'{len(writer.names)} images of shape {writer.shape}')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		'dir_in',
+		type=str,
+		help='folder of .tfrecord files')
+	parser.add_argument(
+		'--file_out',
+		type=str,
+		default='tfrecord.npy',
+		help='output .npy file. its index is written next to it')
+	parser.add_argument(
+		'--channels',
+		type=int,
+		choices=[0, 1, 3, 4],
+		default=0,
+		help='convert every image to this many channels. 0 keeps them as stored, which must be the same for all')
+	parser.add_argument(
+		'--chunk',
+		type=int,
+		default=64,
+		help='records decoded by a worker at a time')
+	add_arguments(parser)
+	args = parser.parse_args()
+	main(args.dir_in, args.file_out, args.channels, args.chunk, Runner.from_args(args))
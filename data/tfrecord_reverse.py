@@ -2,55 +2,132 @@
 To validate the .tfrecord files.
 Should produce the same .png files that the .tfrecord files were made from.
 The file names and paths are not preserved.
+With --verify nothing is written. Each record is hashed as the manifest.json
+that tfrecord.py wrote with the files says, and compared against it.
+Only a manifest written before 'digest' needs the pixels of each record decoded.
 '''
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+import io
+import json
 import os
-import tensorflow as tf
-
-os.environ["CUDA_VISIBLE_DEVICES"] = '-1'
-
-
-feature_description = { # must match that which created the tf records
-	'image_bytes': tf.io.FixedLenFeature([], tf.string),
-	'image_shape': tf.io.FixedLenFeature([3], tf.int64), # 3: height, width, channels
-}
+from PIL import Image
+from runner import Runner, add_arguments
+import sys
+from tfrecord import digest
+from tfrecord_io import IndexedReader, decode_example
 
 
 # parse record data
 def parse_function(proto): # proto: serialized protobuf string
-	return tf.io.parse_single_example(proto, feature_description)
+	# must match that which created the tf records
+	# image_shape: height, width, channels
+	feature = decode_example(proto)
+	return {
+		'image_bytes': feature['image_bytes'][0],
+		'image_shape': feature['image_shape']
+	}
 
 
 # decode image from parsed record
 def decode_image(parsed_record):
-	image = tf.io.decode_png(
-		parsed_record['image_bytes']
-	)
+	image = Image.open(io.BytesIO(parsed_record['image_bytes']))
+	image.load()
 	return image
 
 
 def worker(args):
-	dir_in, dir_out, i, filename = args
-	filepath = f'{dir_in}/{filename}'
-	os.makedirs(f'{dir_out}/{i}', exist_ok=True)
-	raw_dataset = tf.data.TFRecordDataset(filepath)
-
-	# apply transformations per image datum
-	parsed_dataset = raw_dataset.map(parse_function)
-	decoded_dataset = parsed_dataset.map(decode_image)
+	dir_in, dir_out, i, filename, start, stop = args
+	reader = IndexedReader(f'{dir_in}/{filename}')
 
 	# access data
-	for j, image in enumerate(decoded_dataset):
+	for j, proto in enumerate(reader.records(start, stop), start):
+		image = decode_image(parse_function(proto))
 		filepath = f'{dir_out}/{i}/{j}'
-		tf.io.write_file(filepath, tf.io.encode_png(image))
-
-
-def main(dir_in, dir_out):
-	filenames = os.listdir(dir_in)
-	args = [(dir_in, dir_out, i, f) for i, f in enumerate(filenames)]
-	with ProcessPoolExecutor() as executor:
-		executor.map(worker, args)
+		image.save(filepath, format='PNG')
+	reader.close()
+
+
+def verify_worker(args):
+	dir_in, filename, start, stop, kind = args
+	reader = IndexedReader(f'{dir_in}/{filename}')
+	digests = []
+	for n in range(start, stop):
+		# a record that fails its checksum or does not decode has no digest
+		try:
+			record = parse_function(reader.read(n))
+			digests.append(digest(kind, record['image_bytes'], record['image_shape']))
+		except (ValueError, OSError, SyntaxError):
+			digests.append(None)
+	reader.close()
+	return filename, start, digests
+
+
+def report(label, items, limit=10):
+	print(f'{label}: {len(items)}')
+	for item in items[:limit]:
+		print('  ', *item)
+
+
+def verify(dir_in, runner=None):
+	runner = runner or Runner()
+	with open(f'{dir_in}/manifest.json', 'r') as f:
+		manifest = json.load(f)
+	kind = manifest.get('digest', 'pixels')
+	# each shard's records: source, digest, ...
+	manifest = {name: shard['tiles'] for name, shard in manifest['shards'].items()}
+	filenames = sorted(f for f in os.listdir(dir_in) if f.endswith('.tfrecord'))
+
+	# digest of each record in each file, read in parallel ranges
+	found = {}
+	args = []
+	for f in filenames:
+		reader = IndexedReader(f'{dir_in}/{f}')
+		found[f] = [None] * len(reader)
+		for start, stop in reader.ranges(runner.workers):
+			args.append((dir_in, f, start, stop, kind))
+	with runner:
+		for f, start, digests in runner.map(verify_worker, args, label=lambda a: f'{a[1]} {a[2]}:{a[3]}'):
+			found[f][start:start + len(digests)] = digests
+	#verify_worker(args[0]) # debug
+
+	expected = Counter(t[1] for tiles in manifest.values() for t in tiles)
+	actual = Counter(d for digests in found.values() for d in digests if d)
+	sources = {t[1]: t[0] for tiles in manifest.values() for t in tiles}
+
+	# tiles in the manifest that are not in any file
+	missing = [(sources[d], n) for d, n in (expected - actual).items()]
+	# tiles in the files more times than in the manifest
+	duplicate = [(sources[d], n) for d, n in (actual - expected).items() if d in expected]
+	# records that are corrupt or whose pixels match no tile in the manifest, and the tile expected there
+	mismatched = []
+	for f, digests in found.items():
+		tiles = manifest.get(f, [])
+		for n, d in enumerate(digests):
+			if d not in expected:
+				mismatched.append((f, n, tiles[n][0] if n < len(tiles) else None))
+
+	print(f'{len(filenames)} files, {sum(len(d) for d in found.values())} records, {sum(expected.values())} tiles in the manifest')
+	report('files missing', [(f,) for f in sorted(set(manifest) - set(found))])
+	report('files not in the manifest', [(f,) for f in sorted(set(found) - set(manifest))])
+	report('missing tiles', missing)
+	report('duplicate tiles', duplicate)
+	report('mismatched tiles', mismatched)
+	return not (missing or duplicate or mismatched)
+
+
+def main(dir_in, dir_out, runner=None):
+	runner = runner or Runner()
+	filenames = sorted(f for f in os.listdir(dir_in) if f.endswith('.tfrecord'))
+	# each file is split into ranges of records, read in parallel through its index
+	args = []
+	for i, f in enumerate(filenames):
+		os.makedirs(f'{dir_out}/{i}', exist_ok=True)
+		reader = IndexedReader(f'{dir_in}/{f}')
+		for start, stop in reader.ranges(runner.workers):
+			args.append((dir_in, dir_out, i, f, start, stop))
+	with runner:
+		runner.run(worker, args, label=lambda a: f'{a[3]} {a[4]}:{a[5]}')
 	#worker(args[0]) # debug
 
 
@@ -65,8 +142,17 @@ if __name__ == '__main__':
 		type=str,
 		default='tfrecord_reverse',
 		help='output folder')
+	parser.add_argument(
+		'--verify',
+		action='store_true',
+		help='compare the pixels of every record against manifest.json instead of writing .png files')
+	add_arguments(parser)
 	args = parser.parse_args()
-	main(args.dir_in, args.dir_out)
+	if args.verify:
+		if not verify(args.dir_in, Runner.from_args(args)):
+			sys.exit(1)
+	else:
+		main(args.dir_in, args.dir_out, Runner.from_args(args))
 
 
 
@@ -3,12 +3,12 @@ Automatically identify shapes and fill them with color.
 Optionally blend.
 '''
 import argparse
-from concurrent.futures import ProcessPoolExecutor
 import math
 import numpy as np
 import os
 from PIL import Image, ImageDraw
 from random import randrange, shuffle
+from runner import Runner, add_arguments, image_bytes
 import sys
 import time
 
@@ -136,12 +136,14 @@ def blend_px(x, y, img):
 
 def worker(args):
 	dir_in, palette, dir_out, overlay, blend, filename = args
+	# the palette is opened in each worker, not sent with every task
+	palette_img = Image.open(palette)
 
 	img = Image.open(f'{dir_in}/{filename}')
 	img = bitmap(img).convert('RGB')
 	draw = ImageDraw.Draw(img)
 	(w, h) = img.size
-	(pw, ph) = palette.size
+	(pw, ph) = palette_img.size
 
 	# fill space
 	for x in range(w):
@@ -151,7 +153,7 @@ def worker(args):
 				if overlay:
 					color = color_match(pix, palette)
 				else:
-					color = palette.getpixel((randrange(pw), randrange(ph)))
+					color = palette_img.getpixel((randrange(pw), randrange(ph)))
 				if pix != []:
 					for p in pix:
 						draw.point(p, fill=color)
@@ -173,13 +175,14 @@ def worker(args):
 	img.save(f'{dir_out}/{filename}')
 
 
-def main(dir_in, palette, dir_out, overlay, blend):
-	palette = Image.open(palette)
+def main(dir_in, palette, dir_out, overlay, blend, runner=None):
 	os.makedirs(dir_out, exist_ok=True)
 	filenames = os.listdir(dir_in)
 	args = [(dir_in, palette, dir_out, overlay, blend, f) for f in filenames]
-	with ProcessPoolExecutor() as executor:
-		executor.map(worker, args)
+	# each image is held decoded as RGB
+	cost = lambda a: image_bytes(f'{dir_in}/{a[-1]}')
+	with runner or Runner() as runner:
+		runner.run(worker, args, cost, lambda a: a[-1])
 	#worker(args[0]) # debug
 
 
@@ -206,8 +209,9 @@ if __name__ == '__main__':
 		'--blend',
 		action='store_true',
 		help='blend with no GPU support')
+	add_arguments(parser)
 	args = parser.parse_args()
-	main(args.dir_in, args.palette, args.dir_out, args.overlay, args.blend)
+	main(args.dir_in, args.palette, args.dir_out, args.overlay, args.blend, Runner.from_args(args))
 
 
 
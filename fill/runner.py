@@ -0,0 +1,161 @@
+'''
+Runs the tasks of a script on a pool of worker processes.
+- --workers sets how many processes, every cpu by default.
+- Tasks are submitted a few at a time as workers free up, so the args of tasks not yet started are never all held at once.
+- --memory is a budget in GB for the tasks in flight, each costed by the bytes it is expected to hold,
+  e.g. a decoded scan, so only so many giant pages are worked at once.
+- A task that fails is reported with its traceback, the others go on,
+  and once the pool is closed an error is raised if any failed.
+- The time of each task is measured in its worker, printed with --timing, and summed up at the end.
+'''
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+from PIL import Image
+import statistics
+import time
+import traceback
+
+
+def add_arguments(parser):
+	parser.add_argument(
+		'--workers',
+		type=int,
+		default=None,
+		help='worker processes. every cpu by default')
+	parser.add_argument(
+		'--memory',
+		type=float,
+		default=None,
+		help='GB the tasks in flight may hold, e.g. decoded scans. no limit by default')
+	parser.add_argument(
+		'--timing',
+		action='store_true',
+		help='print the time of each task as it finishes')
+
+
+def image_bytes(filepath):
+	# bytes of an image once decoded, read from its header
+	# an image that cannot be read costs nothing, and its task reports why
+	try:
+		with Image.open(filepath) as im:
+			w, h = im.size
+			return w * h * len(im.getbands())
+	except OSError:
+		return 0
+
+
+def timed(fn, task):
+	start = time.perf_counter()
+	result = fn(task)
+	return result, time.perf_counter() - start
+
+
+class Runner:
+	def __init__(self, workers=None, memory=None, timing=False):
+		self.workers = workers or os.cpu_count()
+		self.budget = memory * 2**30 if memory else None
+		self.timing = timing
+		self.window = 2 * self.workers # tasks in flight, so the next is ready when a worker frees up
+		self.executor = None
+		self.times = [] # (seconds, label) of each task that finished
+		self.failed = []
+		self.start = None
+
+	@classmethod
+	def from_args(cls, args):
+		return cls(args.workers, args.memory, args.timing)
+
+	def __enter__(self):
+		self.executor = ProcessPoolExecutor(self.workers)
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.executor.shutdown(cancel_futures=exc[0] is not None)
+		self.executor = None
+		self.summary()
+		if self.failed and exc[0] is None:
+			raise RuntimeError(f'{len(self.failed)} tasks failed: {", ".join(map(str, self.failed[:10]))}')
+
+	def submit(self, fn, task, label=None):
+		# the future's result is the task's result, and its time is recorded when it is read through result()
+		future = self.executor.submit(timed, fn, task)
+		future.label = label
+		return future
+
+	def result(self, future, report=True):
+		# with report, a failure is printed with its traceback before it is raised
+		try:
+			result, seconds = future.result()
+		except Exception as e:
+			self.failed.append(future.label)
+			if report:
+				print(f'{future.label}: failed')
+				traceback.print_exception(type(e), e, e.__traceback__)
+			raise
+		self.times.append((seconds, future.label))
+		if self.timing:
+			print(f'{future.label}: {seconds:.2f}s')
+		return result
+
+	def tasks(self, fn, tasks, cost=None, label=None, ordered=True):
+		# yields (task, future) as futures finish, in the order of tasks if ordered
+		# tasks may be a generator, it is drawn from only as tasks are submitted
+		cost = cost or (lambda task: 0)
+		label = label or (lambda task: repr(task)[:80])
+		pending = deque()
+		held = 0
+		tasks = iter(tasks)
+		nxt = next(tasks, None)
+		while nxt is not None or pending:
+			# submit while there is room in the window and the budget
+			# a task over the budget on its own still runs, alone
+			while nxt is not None and len(pending) < self.window:
+				c = cost(nxt)
+				if pending and self.budget and held + c > self.budget:
+					break
+				pending.append((nxt, self.submit(fn, nxt, label(nxt)), c))
+				held += c
+				nxt = next(tasks, None)
+			if ordered:
+				done = pending.popleft()
+			else:
+				finished, _ = wait([f for _, f, _ in pending], return_when=FIRST_COMPLETED)
+				done = next(p for p in pending if p[1] in finished)
+				pending.remove(done)
+			task, future, c = done
+			future.exception() # wait for it
+			held -= c
+			yield task, future
+
+	def map(self, fn, tasks, cost=None, label=None):
+		# results in the order of tasks. a failed task raises its error here
+		for _, future in self.tasks(fn, tasks, cost, label):
+			yield self.result(future, report=False)
+
+	def completed(self, fn, tasks, cost=None, label=None):
+		# (task, result, error) as each task finishes. a failed task is reported, and the rest go on
+		for task, future in self.tasks(fn, tasks, cost, label, ordered=False):
+			try:
+				yield task, self.result(future), None
+			except Exception as e:
+				yield task, None, e
+
+	def run(self, fn, tasks, cost=None, label=None):
+		# every task, for its side effects
+		for _ in self.completed(fn, tasks, cost, label):
+			pass
+
+	def summary(self):
+		if not self.times and not self.failed:
+			return
+		wall = time.perf_counter() - self.start
+		line = f'{len(self.times)} tasks in {wall:.1f}s on {self.workers} workers'
+		if self.times:
+			seconds = [s for s, _ in self.times]
+			slowest = max(self.times, key=lambda t: t[0])
+			line += f', task time median {statistics.median(seconds):.2f}s max {slowest[0]:.2f}s ({slowest[1]})'
+		if self.failed:
+			line += f', {len(self.failed)} failed'
+		print(line)
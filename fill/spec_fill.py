@@ -4,12 +4,12 @@ Shapes symmetric across vertical or horizontal axes are
 filled with the same color.
 '''
 import argparse
-from concurrent.futures import ProcessPoolExecutor
 import math
 import numpy as np
 import os
 from PIL import Image, ImageDraw
 from random import randrange, shuffle
+from runner import Runner, add_arguments, image_bytes
 import sys
 import time
 
@@ -239,13 +239,14 @@ def process(args):
 	img.save(os.path.join(dir_out, filename))
 
 
-def main(dir_in, palette, dir_out, blend):
+def main(dir_in, palette, dir_out, blend, runner=None):
 	get_colors(palette)
 	os.makedirs(dir_out, exist_ok=True)
 	filenames = os.listdir(dir_in)
 	args = [(dir_in, dir_out, blend, f) for f in filenames]
-	with ProcessPoolExecutor() as executor:
-		executor.map(process, args)
+	cost = lambda a: image_bytes(f'{dir_in}/{a[-1]}')
+	with runner or Runner() as runner:
+		runner.run(process, args, cost, lambda a: a[-1])
 	#process(args[0]) # debug
 
 
@@ -269,8 +270,9 @@ if __name__ == '__main__':
 		action='store_true',
 		default=False,
 		help='blend with no GPU support')
+	add_arguments(parser)
 	args = parser.parse_args()
-	main(args.dir_in, args.palette, args.dir_out, args.blend)
+	main(args.dir_in, args.palette, args.dir_out, args.blend, Runner.from_args(args))
 
 
 
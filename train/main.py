@@ -3,6 +3,8 @@ Initiate or resume training.
 Output folder must contain an options.json file that has all the hyperparameters
 as seen in TrainingOptions.
 Automatically resumes from latest checkpoint in the output folder.
+The tf.data settings under "pipeline" in options.json are read again on resume, so they can be tuned between runs.
+With --benchmark, only the input pipeline runs, distributed to the GPUs as in training, and its images per second are printed.
 '''
 import argparse
 import json
@@ -11,17 +13,15 @@ import pickle
 os.environ['TF_USE_LEGACY_KERAS'] = '1'
 import tensorflow as tf
 import time
-from train import TrainingOptions, TrainingState, train
+from train import TrainingOptions, TrainingState, benchmark_dataset, make_distributed_dataset, train
 from typing import List, Optional
 
 
-def init_training(dir_out):
-	strategy = tf.distribute.MirroredStrategy()
-
+def read_options(dir_out):
 	with open(f'{dir_out}/options.json', 'r') as f:
 		opt = json.load(f)
 
-	options = TrainingOptions(
+	return TrainingOptions(
 		opt['dataset_file_pattern'],
 		opt['resolution'],
 		opt['replica_batch_size'],
@@ -30,7 +30,15 @@ def init_training(dir_out):
 		opt['learning_rate'],
 		opt['latent_size'],
 		opt['beta_1'],
-		opt['beta_2'])
+		opt['beta_2'],
+		opt.get('dihedral', False),
+		opt.get('pipeline', {}))
+
+
+def init_training(dir_out):
+	strategy = tf.distribute.MirroredStrategy()
+
+	options = read_options(dir_out)
 
 	training_state = TrainingState(options)
 
@@ -47,6 +55,8 @@ def resume_training(dir_out, checkpoint_i):
 		filepath = f'{dir_out}/{checkpoint_i}.checkpoint'
 		with open(filepath, 'rb') as f:
 			state = pickle.loads(f.read())
+		# the pipeline does not change the model, so options.json may tune it on resume
+		state.options.pipeline = read_options(dir_out).pipeline
 		training_state = TrainingState(
 			state.options,
 			state.epoch_i,
@@ -59,6 +69,18 @@ def resume_training(dir_out, checkpoint_i):
 		training_state)
 
 
+def benchmark(dir_out, batch_count):
+	strategy = tf.distribute.MirroredStrategy()
+
+	options = read_options(dir_out)
+	global_batch_size = options.replica_batch_size * strategy.num_replicas_in_sync
+	# distributed as in training, so device_prefetch is timed too
+	image_dataset = make_distributed_dataset(strategy, options, global_batch_size)
+
+	images_per_sec = benchmark_dataset(image_dataset, global_batch_size, batch_count)
+	print(f'{batch_count} batches of {global_batch_size}: {images_per_sec:.1f} images/sec')
+
+
 def main(dir_out):
 	files = os.listdir(dir_out)
 	checkpoints = [f for f in files if f.endswith('checkpoint')]
@@ -76,8 +98,16 @@ if __name__ == '__main__':
 		'dir_out',
 		type=str,
 		help='folder to save checkpoints. must contain options.json')
+	parser.add_argument(
+		'--benchmark',
+		type=int,
+		default=None,
+		help='time this many batches of the input pipeline alone, without training')
 	args = parser.parse_args()
-	main(args.dir_out)
+	if args.benchmark:
+		benchmark(args.dir_out, args.benchmark)
+	else:
+		main(args.dir_out)
 
 
 
@@ -48,6 +48,16 @@ def lerp(start: tf.Tensor, end: tf.Tensor, factor: tf.Tensor) -> tf.Tensor:
     return start + (end - start) * factor
 
 
+def random_dihedral(images):
+    # each square image in the batch becomes a random one of its 8 rotations and flips
+    # a transpose and two flips, each applied or not, reach all 8
+    choice = tf.random.uniform([tf.shape(images)[0], 3, 1, 1, 1], maxval=2, dtype=tf.int32) > 0
+    images = tf.where(choice[:, 0], tf.transpose(images, [0, 2, 1, 3]), images)
+    images = tf.where(choice[:, 1], tf.reverse(images, [1]), images)
+    images = tf.where(choice[:, 2], tf.reverse(images, [2]), images)
+    return images
+
+
 def reduce_std_nan_safe(x, axis=None, keepdims=False, epsilon=1e-7):
     y = tf.cast(x, tf.float32)
     mean = tf.reduce_mean(y, axis=axis, keepdims=True)
@@ -1,10 +1,12 @@
 import functools
 from models import create_discriminator, create_generator
+import numpy as np
 import os
 import pickle
 from serialize import deserialize_model, serialize_model
 import tensorflow as tf
 from tensor_ops import lerp
+import time
 from training_loop import training_loop
 
 
@@ -19,19 +21,129 @@ def decode_record_image(record_bytes):
     return image
 
 
-def make_real_image_dataset(
+def decode_record_png(record_bytes, channels, resolution):
+    # decode_png to a fixed number of channels, so every image has the same static shape
+    schema = {'image_bytes': tf.io.FixedLenFeature([], dtype=tf.string)}
+    example = tf.io.parse_single_example(record_bytes, schema)
+    image = tf.io.decode_png(example['image_bytes'], channels=channels)
+    return tf.ensure_shape(image, [resolution, resolution, channels])
+
+
+def make_record_batches(
         batch_size: int,
         file_pattern: str,
+        resolution: int = None,
+        interleave: int = 0,
+        parallel_calls: int = None,
+        deterministic: bool = True,
+        channels: int = 0,
+        shuffle_buffer: int = 1000,
         ) -> tf.data.Dataset:
     file_names = tf.io.gfile.glob(file_pattern)
 
-    return tf.data.TFRecordDataset(file_names
-        ).map(decode_record_image
-        ).map(lambda image: tf.image.convert_image_dtype(image, tf.float32, saturate=True)
-        ).shuffle(1000
+    # the serialized records are shuffled, so the buffer holds compressed .png bytes, not decoded images
+    if interleave:
+        # the shards are reshuffled each pass, and records are drawn from several at once
+        dataset = tf.data.Dataset.from_tensor_slices(file_names
+            ).shuffle(len(file_names)
+            ).repeat(
+            ).interleave(
+                tf.data.TFRecordDataset,
+                cycle_length=interleave,
+                num_parallel_calls=interleave,
+                deterministic=deterministic
+            ).shuffle(shuffle_buffer)
+    else:
+        dataset = tf.data.TFRecordDataset(file_names
+            ).shuffle(shuffle_buffer
+            ).repeat()
+
+    # images are decoded after the shuffle and batched as uint8,
+    # and scaled to float32 in the replica step (training_loop.py), so a quarter of the bytes go to the device
+    if channels:
+        decode = functools.partial(decode_record_png, channels=channels, resolution=resolution)
+    else:
+        decode = decode_record_image
+    return dataset.map(decode, num_parallel_calls=parallel_calls, deterministic=deterministic
+        ).batch(batch_size, drop_remainder=True)
+
+
+def make_memmap_batches(
+        batch_size: int,
+        file_path: str,
+        resolution: int = None,
+        parallel_calls: int = None,
+        deterministic: bool = True,
+        ) -> tf.data.Dataset:
+    # batches of images already decoded to a uint8 stack (data/tfrecord_npy.py), read from disk as they are needed
+    stack = np.load(file_path, mmap_mode='r')
+    if resolution and stack.shape[1:3] != (resolution, resolution):
+        raise ValueError(f'{file_path} has images of {stack.shape[1:3]}, not {resolution}x{resolution}')
+
+    def read_batch(indices):
+        # sorted, so a batch is read front to back
+        return stack[np.sort(indices)]
+
+    def read(indices):
+        images = tf.numpy_function(read_batch, [indices], tf.uint8)
+        return tf.ensure_shape(images, (batch_size,) + stack.shape[1:])
+
+    # each pass draws every image once, in a new order
+    return tf.data.Dataset.range(stack.shape[0]
+        ).shuffle(stack.shape[0]
         ).repeat(
-        ).batch(batch_size
-        ).prefetch(tf.data.AUTOTUNE)
+        ).batch(batch_size, drop_remainder=True
+        ).map(read, num_parallel_calls=parallel_calls, deterministic=deterministic)
+
+
+def make_real_image_dataset(
+        batch_size: int,
+        file_pattern: str,
+        resolution: int = None,
+        pipeline: dict = None,
+        ) -> tf.data.Dataset:
+    # pipeline holds the optional tf.data settings of options.json:
+    # - interleave: shards read at once. 0 reads them one after another
+    # - parallel_calls: records decoded at once. -1 lets autotune choose
+    # - deterministic: false lets a record that is ready pass one that is still decoding
+    # - channels: decode_png to this many channels, which gives every batch a static shape
+    # - shuffle_buffer: records in the shuffle buffer
+    # - ram_budget: GB that autotune may use for its buffers
+    # a file_pattern ending in .npy is a stack of decoded images, read instead of .tfrecord files.
+    # it needs no decoding, so only parallel_calls, deterministic and ram_budget apply to it
+    pipeline = pipeline or {}
+    interleave = pipeline.get('interleave', 0)
+    parallel_calls = pipeline.get('parallel_calls', None)
+    deterministic = pipeline.get('deterministic', True)
+    channels = pipeline.get('channels', 0)
+    shuffle_buffer = pipeline.get('shuffle_buffer', 1000)
+    if file_pattern.endswith('.npy'):
+        dataset = make_memmap_batches(batch_size, file_pattern, resolution, parallel_calls, deterministic)
+    else:
+        dataset = make_record_batches(
+            batch_size, file_pattern, resolution, interleave, parallel_calls, deterministic, channels, shuffle_buffer)
+
+    options = tf.data.Options()
+    options.deterministic = deterministic
+    if 'ram_budget' in pipeline:
+        options.autotune.ram_budget = int(pipeline['ram_budget'] * 2**30)
+    return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+
+def benchmark_dataset(
+        dataset: tf.distribute.DistributedDataset,
+        batch_size: int,
+        batch_count: int,
+        warmup_count: int = 10,
+        ) -> float:
+    # images per second the pipeline alone delivers to the replicas, after it has warmed up
+    iterator = iter(dataset)
+    for _ in range(warmup_count):
+        next(iterator)
+    start = time.perf_counter()
+    for _ in range(batch_count):
+        next(iterator)
+    return batch_count * batch_size / (time.perf_counter() - start)
 
 
 class TrainingOptions:
@@ -45,7 +157,9 @@ class TrainingOptions:
 			learning_rate: float = 0.002,
 			latent_size = 64,
 			beta_1 = None,
-			beta_2 = None
+			beta_2 = None,
+			dihedral = False,
+			pipeline = None
 			):
 		assert epoch_sample_count % replica_batch_size == 0
 		assert total_sample_count % epoch_sample_count == 0
@@ -59,6 +173,8 @@ class TrainingOptions:
 		self.latent_size = latent_size
 		self.beta_1 = beta_1
 		self.beta_2 = beta_2
+		self.dihedral = dihedral
+		self.pipeline = pipeline or {}
 
 	@property
 	def epoch_count(self):
@@ -112,6 +228,28 @@ class CheckpointStateCallback(tf.keras.callbacks.Callback):
 			f.write(pickle.dumps(self.state))
 
 
+def make_distributed_dataset(
+		strategy: tf.distribute.MirroredStrategy,
+		options: TrainingOptions,
+		global_batch_size: int
+		) -> tf.distribute.DistributedDataset:
+	# the real images split across the replicas, as train() reads them and main.py --benchmark times them
+	# absent from older checkpoints
+	pipeline = getattr(options, 'pipeline', {})
+	dataset = make_real_image_dataset(
+		global_batch_size,
+		file_pattern=options.dataset_file_pattern,
+		resolution=options.resolution,
+		pipeline=pipeline)
+	# device_prefetch batches per replica are copied to the GPUs ahead of the step that needs them
+	input_options = None
+	if 'device_prefetch' in pipeline:
+		input_options = tf.distribute.InputOptions(
+			experimental_fetch_to_device=True,
+			experimental_per_replica_buffer_size=pipeline['device_prefetch'])
+	return strategy.experimental_distribute_dataset(dataset, input_options)
+
+
 def train(
 		strategy: tf.distribute.MirroredStrategy,
 		dir_out: str,
@@ -129,10 +267,7 @@ def train(
 
 	global_batch_size = options.replica_batch_size * strategy.num_replicas_in_sync
 
-	image_dataset = strategy.experimental_distribute_dataset(
-		make_real_image_dataset(
-			global_batch_size,
-			file_pattern=options.dataset_file_pattern))
+	image_dataset = make_distributed_dataset(strategy, options, global_batch_size)
 
 	state.epoch_i = training_loop(
 		checkpoint_callback,
@@ -146,7 +281,8 @@ def train(
 		options.epoch_sample_count,
 		learning_rate=options.learning_rate,
 		beta_1=options.beta_1,
-		beta_2=options.beta_2)
+		beta_2=options.beta_2,
+		dihedral=getattr(options, 'dihedral', False)) # absent from older checkpoints
 
 
 
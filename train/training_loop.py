@@ -1,4 +1,5 @@
 import tensorflow as tf
+from tensor_ops import random_dihedral
 from typing import Dict, List
 
 
@@ -15,7 +16,8 @@ def training_loop(
 		learning_rate: float,
 		beta_1: float,
 		beta_2: float,
-		d_regularization_interval: int = 16
+		d_regularization_interval: int = 16,
+		dihedral: bool = False
 		) -> int:
 
 	global_batch_size = replica_batch_size * strategy.num_replicas_in_sync
@@ -52,6 +54,15 @@ def training_loop(
 		return tf.reduce_sum(x) / global_batch_size
 
 
+	def to_float(real_images: tf.Tensor) -> tf.Tensor:
+		# the dataset yields uint8 batches, scaled to [0, 1] here on the replica
+		# with dihedral, each image becomes a random one of its 8 rotations and flips first,
+		# on the device rather than in the input pipeline, instead of storing all 8 (spec_rotateflip.py)
+		if dihedral:
+			real_images = random_dihedral(real_images)
+		return tf.image.convert_image_dtype(real_images, tf.float32, saturate=True)
+
+
 	@tf.function
 	def take_g_step() -> Dict[str, tf.Tensor]:
 		noise = tf.random.normal(shape=(replica_batch_size, noise_size))
@@ -69,6 +80,7 @@ def training_loop(
 
 	@tf.function
 	def take_d_classification_step(real_images) -> Dict[str, tf.Tensor]:
+		real_images = to_float(real_images)
 		noise = tf.random.normal(shape=(replica_batch_size, noise_size))
 		fake_images = generator(noise, training=False)
 		real_classifications = discriminator(real_images, training=True)
@@ -90,6 +102,7 @@ def training_loop(
 
 	@tf.function
 	def take_d_reg_step(real_images) -> Dict[str, tf.Tensor]:
+		real_images = to_float(real_images)
 		real_classifications = discriminator(real_images, training=True)
 		real_grads = tf.gradients(tf.reduce_sum(real_classifications), real_images)
 		gradient_loss = reduce_across_batch(tf.reduce_sum(tf.square(real_grads), axis=[1, 2, 3]))